@@ -1,14 +1,30 @@
 from flask import Flask, request, jsonify
+from werkzeug.exceptions import HTTPException
 import torch
 import cv2
 import numpy as np
-import pandas as pd
 import requests
 import os
-from io import BytesIO
 from PIL import Image
-import base64
+import binascii
+import contextlib
+import functools
+import json
 import logging
+import math
+import queue
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import metrics
+from cpu_config import configure_threads
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -19,51 +35,743 @@ app = Flask(__name__)
 # Configuración de Telegram
 TOKEN = os.getenv("TELEGRAM_TOKEN", "8107580499:AAG3FyXhtmXSPRb0To3hgZCa3WTTQm9Wfbo")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "-1002221266716")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
 
-def send_telegram_alert(image_array, detections):
-    """Envía una alerta a Telegram con la imagen y las detecciones (excepto 'imprimiendo')"""
-    try:
-        # Filtrar detecciones para excluir 'imprimiendo'
-        filtered_detections = detections[detections['name'].str.lower() != 'imprimiendo']
-        
-        # Si no hay detecciones después del filtro, no enviar alerta
-        if filtered_detections.empty:
-            logger.info("No se envía alerta: solo se detectó 'imprimiendo' (estado normal)")
-            return False
-        
+# Configuración de la cola de alertas
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "32"))
+ALERT_MAX_RETRIES = int(os.getenv("ALERT_MAX_RETRIES", "3"))
+ALERT_RETRY_BACKOFF = float(os.getenv("ALERT_RETRY_BACKOFF", "1.0"))  # Segundos, se duplica en cada intento
+ALERT_TIMEOUT = float(os.getenv("ALERT_TIMEOUT", "10"))
+# Estado de las alertas compartido por todos los workers de la máquina (GET /alerts/<id>)
+ALERT_STATUS_DB = os.getenv("ALERT_STATUS_DB", os.path.join(tempfile.gettempdir(), "deteccion_alertas.sqlite3"))
+
+# Supresión de alertas repetidas (por impresora y clase)
+ALERT_COOLDOWN = float(os.getenv("ALERT_COOLDOWN", "600"))  # Segundos sin repetir la misma clase
+ALERT_CONFIRM_N = int(os.getenv("ALERT_CONFIRM_N", "2"))  # La clase debe verse en N...
+ALERT_CONFIRM_M = int(os.getenv("ALERT_CONFIRM_M", "3"))  # ...de los últimos M fotogramas
+
+# Suavizado temporal por impresora: el estado se decide sobre la secuencia de fotogramas
+TEMPORAL_SMOOTHING = os.getenv("TEMPORAL_SMOOTHING", "1") == "1"
+TEMPORAL_ALPHA = float(os.getenv("TEMPORAL_ALPHA", "0.5"))  # Peso del fotograma nuevo en la confianza suavizada
+TEMPORAL_IOU = float(os.getenv("TEMPORAL_IOU", "0.3"))  # IoU mínimo para asociar una detección a una pista
+TEMPORAL_MIN_HITS = int(os.getenv("TEMPORAL_MIN_HITS", str(ALERT_CONFIRM_N)))  # Un error se confirma si se ve en N...
+TEMPORAL_WINDOW = int(os.getenv("TEMPORAL_WINDOW", str(ALERT_CONFIRM_M)))  # ...de los últimos M fotogramas
+TEMPORAL_TTL = float(os.getenv("TEMPORAL_TTL", "900"))  # Segundos sin fotogramas tras los que se reinicia
+
+# Intervalo de captura sugerido al cliente (segundos) según el riesgo observado
+NEXT_INTERVAL_DEFAULT = int(os.getenv("NEXT_INTERVAL_DEFAULT", "30"))
+NEXT_INTERVAL_SUSPICIOUS = int(os.getenv("NEXT_INTERVAL_SUSPICIOUS", "5"))  # Tras detectar un posible error
+NEXT_INTERVAL_STABLE = int(os.getenv("NEXT_INTERVAL_STABLE", "120"))  # Impresión normal sin errores recientes
+NEXT_INTERVAL_IDLE = int(os.getenv("NEXT_INTERVAL_IDLE", "300"))  # Sin actividad de impresión
+
+# Identificación de la impresora que envía cada fotograma
+PRINTER_ID_HEADER = "X-Printer-ID"
+DEFAULT_PRINTER_ID = "default"
+# Impresoras con estado guardado (supresión, seguimiento); el ID lo elige el cliente, así que se acota
+MAX_TRACKED_PRINTERS = int(os.getenv("MAX_TRACKED_PRINTERS", "256"))
+# Estado por impresora compartido por todos los workers de la máquina (supresión, seguimiento)
+PRINTER_STATE_DB = os.getenv("PRINTER_STATE_DB",
+                             os.path.join(tempfile.gettempdir(), "deteccion_impresoras.sqlite3"))
+
+# Tipos de contenido aceptados como cuerpo binario en /detect
+RAW_IMAGE_TYPES = {"image/jpeg", "image/png"}
+
+# Tamaño de los bloques leídos del cuerpo al decodificar base64 en streaming
+BASE64_CHUNK_SIZE = int(os.getenv("BASE64_CHUNK_SIZE", str(64 * 1024)))
+
+# Configuración de carga del modelo
+MODEL_PATH = os.getenv("MODEL_PATH", "modelo/impresion.pt")
+YOLOV5_REPO = os.getenv("YOLOV5_REPO", "vendor/yolov5")  # Copia local fijada del repo de YOLOv5
+YOLOV5_HUB_REF = os.getenv("YOLOV5_HUB_REF", "ultralytics/yolov5:v7.0")  # Solo si no hay copia local
+ALLOW_MODEL_DOWNLOAD = os.getenv("ALLOW_MODEL_DOWNLOAD", "0") == "1"
+
+# Backend de inferencia: torch (eager), onnx (ONNX Runtime), onnx-int8 u openvino.
+# Los modelos exportados se generan con export_model.py y quantize_model.py
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch").lower()
+BACKEND_MODEL_PATHS = {
+    'torch': MODEL_PATH,
+    'onnx': os.getenv("ONNX_MODEL_PATH", os.path.splitext(MODEL_PATH)[0] + '.onnx'),
+    'onnx-int8': os.getenv("ONNX_INT8_MODEL_PATH", os.path.splitext(MODEL_PATH)[0] + '_int8.onnx'),
+    'openvino': os.getenv("OPENVINO_MODEL_PATH", os.path.splitext(MODEL_PATH)[0] + '_openvino_model'),
+}
+
+# Configuración del micro-batching de inferencia
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "20"))  # Ventana para agrupar peticiones
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))  # Máximo de imágenes por pasada
+
+# Control de admisión: profundidad máxima de la cola de inferencia y tiempo máximo de espera
+ADMISSION_MAX_DEPTH = int(os.getenv("ADMISSION_MAX_DEPTH", "64"))  # 0 = sin límite
+ADMISSION_DEADLINE = float(os.getenv("ADMISSION_DEADLINE", "10"))  # Segundos; 0 = sin límite
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # Mínimo para Retry-After
+
+# Caché de resultados para fotogramas casi idénticos (impresora parada o en pausa)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "64"))  # Impresoras en caché; 0 = desactivada
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "120"))  # Segundos desde la última inferencia real
+RESULT_CACHE_MAX_DISTANCE = int(os.getenv("RESULT_CACHE_MAX_DISTANCE", "4"))  # Bits distintos (de 64) del dHash
+
+# Regiones de interés por impresora: {"id": [x1, y1, x2, y2]} en fracciones del fotograma
+ROI_CONFIG_PATH = os.getenv("ROI_CONFIG_PATH", "roi_config.json")
+
+# Resolución de entrada de la red (con onnx/openvino debe coincidir con la de exportación)
+INFERENCE_SIZE = int(os.getenv("INFERENCE_SIZE", "640"))
+
+# Inferencia por tiles (opcional): el fotograma a resolución completa se divide en
+# tiles solapados que pasan por el modelo en una sola tanda, para defectos pequeños
+TILED_INFERENCE = os.getenv("TILED_INFERENCE", "0") == "1"
+TILE_SIZE = int(os.getenv("TILE_SIZE", str(INFERENCE_SIZE)))  # Lado del tile en píxeles
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.2"))  # Fracción del tile compartida con el vecino
+TILE_INCLUDE_FULL = os.getenv("TILE_INCLUDE_FULL", "1") == "1"  # Añadir el fotograma completo (objetos grandes)
+TILE_NMS_IOU = float(os.getenv("TILE_NMS_IOU", "0.5"))  # IoU para fusionar detecciones entre tiles
+# Decodificar JPEGs a escala reducida (1/2, 1/4, 1/8) si son mucho mayores que la red
+REDUCED_DECODE = os.getenv("REDUCED_DECODE", "1") == "1"
+
+# Límites de tamaño por petición (413 antes de leer o decodificar la imagen completa)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(16 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(4096 * 4096)))
+HEADER_PROBE_BYTES = 128 * 1024  # Bytes leídos para localizar la cabecera JPEG/PNG
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+# Límite propio de OpenCV para formatos cuya cabecera no se analiza aquí
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(MAX_IMAGE_PIXELS))
+
+# Clase que indica impresión normal (no genera alertas)
+NORMAL_CLASS = 'imprimiendo'
+
+class DetectionResult:
+    """Detecciones de una imagen respaldadas directamente por el array xyxy de YOLOv5.
+
+    `boxes` es un array (N, 6) con columnas x1, y1, x2, y2, confianza y clase.
+    Evita construir un DataFrame por petición: el filtrado por clase y la
+    serialización se hacen de forma vectorizada con numpy.
+    """
+
+    def __init__(self, boxes, names):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 6)
+        self.names = names
+        lookup = _class_lookup(tuple(names[i] for i in range(len(names))))
+        self.labels = lookup[self.boxes[:, 5].astype(np.int64)]
+
+    @classmethod
+    def from_results(cls, results, index=0):
+        """Crea el resultado a partir de un objeto Detections de YOLOv5"""
+        return cls(results.xyxy[index].cpu().numpy(), results.names)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def filter(self, mask):
+        """Subconjunto de detecciones según una máscara booleana"""
+        subset = DetectionResult.__new__(DetectionResult)
+        subset.boxes = self.boxes[mask]
+        subset.names = self.names
+        subset.labels = self.labels[mask]
+        return subset
+
+    def rescale(self, scale_x, scale_y):
+        """Escala las coordenadas (p. ej. de la imagen reducida al fotograma original)"""
+        if scale_x == 1 and scale_y == 1:
+            return self
+        scaled = self.filter(slice(None))
+        scaled.boxes = self.boxes * np.array([scale_x, scale_y, scale_x, scale_y, 1, 1], dtype=np.float32)
+        return scaled
+
+    def translate(self, offset_x, offset_y):
+        """Desplaza las coordenadas (p. ej. del recorte de la ROI a la imagen completa)"""
+        if offset_x == 0 and offset_y == 0:
+            return self
+        moved = self.filter(slice(None))
+        moved.boxes = self.boxes + np.array([offset_x, offset_y, offset_x, offset_y, 0, 0], dtype=np.float32)
+        return moved
+
+    def errors(self):
+        """Detecciones de error (todas las clases excepto 'imprimiendo')"""
+        return self.filter(np.char.lower(self.labels) != NORMAL_CLASS)
+
+    def to_json(self):
+        """Lista de detecciones en formato JSON serializable"""
+        confidences = self.boxes[:, 4].astype(float).tolist()
+        coordinates = self.boxes[:, :4].astype(np.int64).tolist()
+        return [
+            {
+                "name": name,
+                "confidence": confidence,
+                "coordinates": {"xmin": x1, "ymin": y1, "xmax": x2, "ymax": y2}
+            }
+            for name, confidence, (x1, y1, x2, y2) in zip(self.labels.tolist(), confidences, coordinates)
+        ]
+
+@functools.lru_cache(maxsize=8)
+def _class_lookup(names):
+    """Array de nombres indexable por id de clase (se construye una vez por modelo)"""
+    return np.asarray(names, dtype=str)
+
+def build_alert_message(detections):
+    """Crea el mensaje de alerta con las detecciones (excepto 'imprimiendo').
+
+    Devuelve None si no hay errores que notificar.
+    """
+    # Filtrar detecciones para excluir 'imprimiendo'
+    filtered_detections = detections.errors()
+
+    # Si no hay detecciones después del filtro, no enviar alerta
+    if len(filtered_detections) == 0:
+        logger.info("No se envía alerta: solo se detectó 'imprimiendo' (estado normal)")
+        return None
+
+    message = "⚠ *Detección de error en impresión 3D* ⚠\n\n"
+    for name, (x1, y1, x2, y2, confidence, _) in zip(filtered_detections.labels, filtered_detections.boxes):
+        message += f"🔹 *{name}*\n"
+        message += f"Confianza: {confidence:.2f}\n"
+        message += f"Posición: x1={x1:.0f}, y1={y1:.0f}, x2={x2:.0f}, y2={y2:.0f}\n\n"
+    return message
+
+def send_telegram_alert(photo, message, session=requests):
+    """Envía una foto JPEG con su mensaje a Telegram (un solo intento).
+
+    Devuelve la respuesta HTTP; los errores de conexión se propagan para que
+    el llamante decida si reintentar.
+    """
+    url = f"{TELEGRAM_API_URL}/bot{TOKEN}/sendPhoto"
+    data = {"chat_id": CHAT_ID, "caption": message, "parse_mode": "Markdown"}
+    files = {'photo': ('detection.jpg', photo)}
+    return session.post(url, data=data, files=files, timeout=ALERT_TIMEOUT)
+
+class AlertStatusStore:
+    """Estado de las alertas en un SQLite compartido entre procesos.
+
+    Cada worker de gunicorn tiene su propia cola de alertas, pero la
+    consulta GET /alerts/<id> puede llegar a cualquier worker; guardando el
+    estado en un fichero local (ALERT_STATUS_DB) todos lo ven. Solo se
+    conservan las últimas `history` alertas. Los errores de SQLite se
+    registran sin interrumpir la detección.
+    """
+
+    def __init__(self, path=ALERT_STATUS_DB, history=1000):
+        self.path = path
+        self.history = history
+        self._local = threading.local()
+
+    def _connection(self):
+        # Una conexión por hilo y por proceso (las conexiones no sobreviven a un fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS alerts "
+                               "(alert_id TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def set(self, alert_id, state, attempts=0):
+        try:
+            connection = self._connection()
+            # INSERT OR REPLACE asigna un rowid nuevo: los rowid más bajos son los más antiguos
+            connection.execute("INSERT OR REPLACE INTO alerts VALUES (?, ?, ?)", (alert_id, state, attempts))
+            connection.execute("DELETE FROM alerts WHERE rowid <= (SELECT max(rowid) FROM alerts) - ?",
+                               (self.history,))
+        except sqlite3.Error as e:
+            logger.error(f"No se pudo guardar el estado de la alerta {alert_id}: {e}")
+
+    def get(self, alert_id):
+        try:
+            row = self._connection().execute(
+                "SELECT status, attempts FROM alerts WHERE alert_id = ?", (alert_id,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"No se pudo leer el estado de la alerta {alert_id}: {e}")
+            return None
+        return {"alert_id": alert_id, "status": row[0], "attempts": row[1]} if row else None
+
+class AlertDispatcher:
+    """Cola de envío de alertas a Telegram en segundo plano.
+
+    Las peticiones HTTP solo encolan la alerta y reciben un identificador;
+    un hilo de fondo codifica la imagen, la envía con una sesión HTTP
+    reutilizable y reintenta con espera exponencial ante errores de red,
+    429 o 5xx. Si la cola está llena la alerta se descarta.
+    """
+
+    def __init__(self, max_queue=ALERT_QUEUE_SIZE, max_retries=ALERT_MAX_RETRIES,
+                 backoff=ALERT_RETRY_BACKOFF, store=None):
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.store = store or AlertStatusStore()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Igual que el batcher: hilo perezoso y rearrancado tras un fork
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+                self._thread.start()
+
+    def _set_status(self, alert_id, state, attempts=0):
+        metrics.ALERTS.labels(state).inc()
+        self.store.set(alert_id, state, attempts)
+
+    def status(self, alert_id):
+        """Estado de una alerta: queued, sent, failed o dropped (None si no existe)"""
+        return self.store.get(alert_id)
+
+    def submit(self, image_array, detections):
+        """Encola una alerta y devuelve (alert_id, estado); (None, False) si no hay errores"""
+        message = build_alert_message(detections)
+        if message is None:
+            return None, False
+
+        self._ensure_worker()
+        alert_id = uuid.uuid4().hex[:12]
+        # El estado se guarda antes de encolar para que el hilo de envío no lo
+        # sobrescriba con "queued"; solo se cuenta como encolada si cabe
+        self.store.set(alert_id, "queued")
+        try:
+            self._queue.put_nowait((alert_id, image_array, message))
+        except queue.Full:
+            self._set_status(alert_id, "dropped")
+            logger.warning("Cola de alertas llena: alerta descartada")
+            return alert_id, "dropped"
+        metrics.ALERTS.labels("queued").inc()
+        metrics.ALERT_QUEUE_DEPTH.set(self._queue.qsize())
+        return alert_id, "queued"
+
+    def _run(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        while True:
+            alert_id, image_array, message = self._queue.get()
+            metrics.ALERT_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                self._deliver(session, alert_id, image_array, message)
+            except Exception as e:
+                logger.error(f"Error en send_telegram_alert: {str(e)}")
+                self._set_status(alert_id, "failed")
+
+    def _deliver(self, session, alert_id, image_array, message):
         # Convertir la imagen a bytes
-        is_success, buffer = cv2.imencode(".jpg", image_array)
+        with metrics.timed("jpeg_encode"):
+            is_success, buffer = cv2.imencode(".jpg", image_array)
         if not is_success:
             logger.error("Error al codificar la imagen")
-            return False
-
-        # Enviar la foto
-        photo_bytes = BytesIO(buffer)
-        photo_bytes.seek(0)
-        files = {'photo': ('detection.jpg', photo_bytes)}
-
-        # Crear mensaje con las detecciones filtradas
-        message = "⚠ *Detección de error en impresión 3D* ⚠\n\n"
-        for _, row in filtered_detections.iterrows():
-            message += f"🔹 *{row['name']}*\n"
-            message += f"Confianza: {row['confidence']:.2f}\n"
-            message += f"Posición: x1={row['xmin']:.0f}, y1={row['ymin']:.0f}, x2={row['xmax']:.0f}, y2={row['ymax']:.0f}\n\n"
-
-        # Enviar la foto con el caption
-        url = f"https://api.telegram.org/bot{TOKEN}/sendPhoto"
-        data = {"chat_id": CHAT_ID, "caption": message, "parse_mode": "Markdown"}
-        response = requests.post(url, data=data, files=files)
-
-        if response.status_code != 200:
-            logger.error(f"Error al enviar alerta a Telegram: {response.text}")
-            return False
+            self._set_status(alert_id, "failed")
+            return
+
+        photo = buffer.tobytes()
+        for attempt in range(1, self.max_retries + 2):
+            try:
+                with metrics.timed("telegram_post"):
+                    response = send_telegram_alert(photo, message, session)
+                if response.status_code == 200:
+                    logger.info(f"Alerta {alert_id} enviada a Telegram (errores detectados)")
+                    self._set_status(alert_id, "sent", attempt)
+                    return
+                logger.error(f"Error al enviar alerta a Telegram: {response.text}")
+                retryable = response.status_code == 429 or response.status_code >= 500
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Error de conexión con Telegram: {str(e)}")
+                retryable = True
+
+            if not retryable or attempt > self.max_retries:
+                self._set_status(alert_id, "failed", attempt)
+                return
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+alert_dispatcher = AlertDispatcher()
+
+class PrinterStateStore:
+    """Estado JSON por impresora en un SQLite compartido entre procesos.
+
+    Los fotogramas de una impresora pueden llegar a cualquier worker de
+    gunicorn; la supresión de alertas y el seguimiento temporal guardan
+    aquí su estado para que todos los workers vean la misma secuencia y el
+    mismo periodo de espera. Cada actualización es una lectura-modificación-
+    escritura dentro de BEGIN IMMEDIATE, así que dos workers no pueden
+    pisarse. Se conservan las `max_printers` impresoras actualizadas más
+    recientemente. Si SQLite falla se registra el error y se usa un estado
+    en memoria del proceso.
+    """
+
+    def __init__(self, table, path=PRINTER_STATE_DB, max_printers=MAX_TRACKED_PRINTERS):
+        self.table = table
+        self.path = path
+        self.max_printers = max_printers
+        self._local = threading.local()
+        self._fallback = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Una conexión por hilo y por proceso (las conexiones no sobreviven a un fork)
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Estado efímero: no hace falta sincronizar el disco en cada fotograma
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                               f"(printer_id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def update(self, printer_id, apply):
+        """Aplica `apply(estado) -> (estado_nuevo, resultado)` de forma atómica.
+
+        `estado` es None si la impresora no tiene estado guardado. `apply`
+        no debe tener efectos fuera del estado: si SQLite falla a mitad se
+        vuelve a llamar con el estado en memoria. Devuelve `resultado`.
+        """
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(f"SELECT state FROM {self.table} WHERE printer_id = ?",
+                                         (printer_id,)).fetchone()
+                state, result = apply(json.loads(row[0]) if row else None)
+                # INSERT OR REPLACE asigna un rowid nuevo: los rowid más bajos son los más antiguos
+                connection.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)",
+                                   (printer_id, json.dumps(state)))
+                connection.execute(f"DELETE FROM {self.table} "
+                                   f"WHERE rowid <= (SELECT max(rowid) FROM {self.table}) - ?",
+                                   (self.max_printers,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            return result
+        except sqlite3.Error as e:
+            logger.error(f"No se pudo actualizar el estado de {printer_id} en {self.table}: {e}")
+
+        with self._lock:
+            state, result = apply(self._fallback.get(printer_id))
+            self._fallback[printer_id] = state
+            self._fallback.move_to_end(printer_id)
+            while len(self._fallback) > self.max_printers:
+                self._fallback.popitem(last=False)
+            return result
+
+class AlertSuppressor:
+    """Decide si una detección de error merece una alerta nueva.
+
+    Guarda por impresora los errores de los últimos M fotogramas y la hora
+    de la última alerta de cada clase. Una clase solo dispara alerta cuando
+    se ha visto en N de esos M fotogramas y no está en su periodo de espera;
+    una clase nueva dispara alerta aunque otras sigan en espera (escalado).
+    El estado vive en un PrinterStateStore, compartido por los workers.
+    """
+
+    def __init__(self, cooldown=ALERT_COOLDOWN, confirm_n=ALERT_CONFIRM_N, confirm_m=ALERT_CONFIRM_M,
+                 store=None):
+        self.cooldown = cooldown
+        self.confirm_m = max(1, confirm_m)
+        self.confirm_n = min(max(1, confirm_n), self.confirm_m)
+        self.store = store or PrinterStateStore("alert_suppression")
+
+    def check(self, printer_id, error_classes, now=None, confirmed=False):
+        """Registra un fotograma y devuelve (enviar_alerta, motivo).
+
+        Con `confirmed` las clases ya vienen confirmadas (seguimiento
+        temporal) y no se vuelve a exigir la confirmación N de M. `now` es
+        la hora de reloj (time.time()), común a todos los procesos.
+        """
+        now = time.time() if now is None else now
+        error_classes = frozenset(name.lower() for name in error_classes)
+        return self.store.update(printer_id, lambda state: self._check(state, error_classes, now, confirmed))
+
+    def _check(self, state, error_classes, now, confirmed):
+        state = state or {"history": [], "last_alerts": {}}
+        history = (state["history"] + [sorted(error_classes)])[-self.confirm_m:]
+        # Las clases cuya espera ya terminó no hace falta guardarlas
+        last_alerts = {name: at for name, at in state["last_alerts"].items() if now - at < self.cooldown}
+        decision = self._decide(history, last_alerts, error_classes, now, confirmed)
+        return {"history": history, "last_alerts": last_alerts}, decision
+
+    def _decide(self, history, last_alerts, error_classes, now, confirmed):
+        if not error_classes:
+            return False, None
+
+        if not confirmed:
+            error_classes = {name for name in error_classes
+                             if sum(name in frame for frame in history) >= self.confirm_n}
+        if not error_classes:
+            return False, "pending_confirmation"
+
+        ready = {name for name in error_classes if name not in last_alerts}
+        if not ready:
+            return False, "cooldown"
+
+        for name in ready:
+            last_alerts[name] = now
+        return True, "escalation" if ready != error_classes else "new"
+
+alert_suppressor = AlertSuppressor()
+
+def classify_status(detections):
+    """Estado de un conjunto de detecciones: normal, printing_normal o error_detected"""
+    if len(detections) == 0:
+        return "normal"
+    return "error_detected" if len(detections.errors()) > 0 else "printing_normal"
+
+def suggest_interval(status, frame_status, error_ratio=0.0):
+    """Segundos que el cliente debería esperar hasta la próxima captura"""
+    if status == "error_detected" or frame_status == "error_detected":
+        return NEXT_INTERVAL_SUSPICIOUS
+    if status == "printing_normal" and error_ratio == 0:
+        return NEXT_INTERVAL_STABLE
+    if status == "normal" and frame_status == "normal":
+        return NEXT_INTERVAL_IDLE
+    return NEXT_INTERVAL_DEFAULT
+
+def box_iou(box, boxes):
+    """IoU entre una caja x1, y1, x2, y2 y un array (N, 4) de cajas"""
+    width = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    height = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    inter = width * height
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / (area + areas - inter + 1e-9)
+
+class Track:
+    """Objeto seguido a lo largo de los fotogramas de una impresora"""
+
+    def __init__(self, track_id, name, box, score, window):
+        self.id = track_id
+        self.name = name
+        self.box = box
+        self.score = score
+        self.hits = 1
+        self.recent = deque([True], maxlen=window)  # Visto o no en cada uno de los últimos fotogramas
+
+    @property
+    def recent_hits(self):
+        return sum(self.recent)
+
+    def to_state(self):
+        return {"id": self.id, "name": self.name, "box": self.box.tolist(), "score": self.score,
+                "hits": self.hits, "recent": list(self.recent)}
+
+    @classmethod
+    def from_state(cls, state, window):
+        track = cls(state["id"], state["name"], np.array(state["box"], dtype=np.float32), state["score"], window)
+        track.hits = state["hits"]
+        track.recent = deque(state["recent"], maxlen=window)
+        return track
+
+class TrackedPrinter:
+    """Pistas y estados recientes de una impresora"""
+
+    def __init__(self, window, now):
+        self.tracks = []
+        self.history = deque(maxlen=window)
+        self.updated = now
+        self.next_id = 1
+
+    def new_track_id(self):
+        track_id, self.next_id = self.next_id, self.next_id + 1
+        return track_id
+
+    def to_state(self):
+        return {"tracks": [track.to_state() for track in self.tracks], "history": list(self.history),
+                "updated": self.updated, "next_id": self.next_id}
+
+    @classmethod
+    def from_state(cls, state, window):
+        printer = cls(window, state["updated"])
+        printer.tracks = [Track.from_state(track, window) for track in state["tracks"]]
+        printer.history.extend(state["history"])
+        printer.next_id = state["next_id"]
+        return printer
+
+class TemporalTracker:
+    """Estado de cada impresora a partir de su secuencia de fotogramas.
+
+    Las detecciones se asocian por clase e IoU a pistas. Un error cuenta
+    como confirmado cuando su pista se ha visto en al menos `min_hits` de
+    los últimos `window` fotogramas (por defecto los mismos N de M que la
+    supresión de alertas, que entonces no vuelve a exigirlos). La confianza
+    no se vuelve a umbralizar, ya la filtra model.conf; la confianza
+    suavizada exponencialmente de cada pista solo se informa. Un error
+    todavía sin confirmar deja el estado en "error_pending". El estado de
+    cada impresora vive en un PrinterStateStore, compartido por los
+    workers, para que la secuencia incluya todos sus fotogramas.
+    """
+
+    def __init__(self, alpha=TEMPORAL_ALPHA, iou_thres=TEMPORAL_IOU, min_hits=TEMPORAL_MIN_HITS,
+                 window=TEMPORAL_WINDOW, ttl=TEMPORAL_TTL, store=None):
+        self.alpha = alpha
+        self.iou_thres = iou_thres
+        self.window = max(1, window)
+        self.min_hits = min(max(1, min_hits), self.window)
+        self.ttl = ttl
+        self.store = store or PrinterStateStore("temporal_tracking")
+
+    def update(self, printer_id, detections, now=None):
+        """Añade las detecciones de un fotograma y devuelve el estado de la secuencia"""
+        now = time.time() if now is None else now
+        frame_status = classify_status(detections)
+        return self.store.update(printer_id, lambda state: self._update(state, detections, frame_status, now))
+
+    def _update(self, state, detections, frame_status, now):
+        printer = TrackedPrinter.from_state(state, self.window) if state else None
+        if printer is None or now - printer.updated > self.ttl:
+            # Impresora nueva o inactiva: no mezclar con la secuencia anterior
+            printer = TrackedPrinter(self.window, now)
+
+        printer.updated = now
+        printer.tracks = self._associate(printer, detections)
+        printer.history.append(frame_status)
+        return printer.to_state(), self._summary(printer, frame_status)
+
+    def _associate(self, printer, detections):
+        """Actualiza las pistas con las detecciones (emparejamiento voraz por IoU)"""
+        tracks = printer.tracks
+        boxes, labels = detections.boxes, detections.labels
+        pairs = []
+        for track_index, track in enumerate(tracks):
+            same_class = np.flatnonzero(labels == track.name)
+            if same_class.size:
+                ious = box_iou(track.box, boxes[same_class, :4])
+                pairs += [(iou, track_index, index) for iou, index in zip(ious.tolist(), same_class.tolist())
+                          if iou >= self.iou_thres]
+
+        matched_tracks, matched_detections = set(), set()
+        for _, track_index, index in sorted(pairs, reverse=True):
+            if track_index in matched_tracks or index in matched_detections:
+                continue
+            matched_tracks.add(track_index)
+            matched_detections.add(index)
+            track = tracks[track_index]
+            track.box = boxes[index, :4].copy()
+            track.score = self.alpha * float(boxes[index, 4]) + (1 - self.alpha) * track.score
+            track.hits += 1
+            track.recent.append(True)
+
+        survivors = []
+        for track_index, track in enumerate(tracks):
+            if track_index not in matched_tracks:
+                track.score *= 1 - self.alpha
+                track.recent.append(False)
+                if not track.recent_hits:
+                    # Sin verse en toda la ventana: la pista ya no aporta nada
+                    continue
+            survivors.append(track)
+        for index in range(len(boxes)):
+            if index not in matched_detections:
+                survivors.append(Track(printer.new_track_id(), str(labels[index]), boxes[index, :4].copy(),
+                                       float(boxes[index, 4]), self.window))
+        return survivors
+
+    def _summary(self, printer, frame_status):
+        confirmed = {track.id for track in printer.tracks if track.recent_hits >= self.min_hits}
+        error_classes = sorted({track.name for track in printer.tracks
+                                if track.id in confirmed and track.name.lower() != NORMAL_CLASS})
+        if error_classes:
+            status = "error_detected"
+        elif frame_status == "error_detected":
+            status = "error_pending"
         else:
-            logger.info("Alerta enviada a Telegram (errores detectados)")
-            return True
-            
-    except Exception as e:
-        logger.error(f"Error en send_telegram_alert: {str(e)}")
-        return False
+            status = frame_status
+        return {
+            "status": status,
+            "frame_status": frame_status,
+            "error_classes": error_classes,
+            "error_ratio": sum(s == "error_detected" for s in printer.history) / len(printer.history),
+            "tracks": [
+                {
+                    "id": track.id,
+                    "name": track.name,
+                    "confidence": track.score,
+                    "hits": track.hits,
+                    "recent_hits": track.recent_hits,
+                    "confirmed": track.id in confirmed,
+                    "coordinates": dict(zip(("xmin", "ymin", "xmax", "ymax"), track.box.astype(np.int64).tolist()))
+                }
+                for track in printer.tracks
+            ]
+        }
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                         (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def read_image_header(data):
+    """Lee formato, ancho y alto de la cabecera JPEG o PNG sin decodificar la imagen.
+
+    Devuelve (formato, ancho, alto) o None si la cabecera no se reconoce.
+    """
+    data = memoryview(data).cast('B')
+    if len(data) >= 24 and data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', data[16:24])
+        return 'png', width, height
+
+    if len(data) < 4 or data[:2] != b'\xff\xd8':
+        return None
+
+    # Recorrer los segmentos JPEG hasta el marcador SOF que contiene el tamaño
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return 'jpeg', width, height
+        i += 2 + length
+    return None
+
+def image_too_large(header, max_pixels=MAX_IMAGE_PIXELS):
+    """True si la cabecera indica más píxeles de los permitidos"""
+    return header is not None and header[1] * header[2] > max_pixels
+
+def decode_image(image_bytes, inference_size=INFERENCE_SIZE, header=None, roi=None):
+    """Decodifica la imagen, a escala reducida si es mucho mayor que la red.
+
+    Devuelve (imagen, (escala_x, escala_y)); las escalas convierten las
+    coordenadas de la imagen decodificada a las del fotograma original.
+    La imagen es None si no se pudo decodificar. `header` evita volver a
+    leer la cabecera si el llamante ya lo hizo. Con `inference_size` None
+    la imagen se decodifica siempre a resolución completa. Con `roi` la
+    reducción se elige para que el recorte, no la imagen entera, siga
+    llegando a la resolución de la red.
+    """
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    if nparr.size == 0:
+        return None, (1.0, 1.0)
+
+    header = header or read_image_header(nparr)
+    flag = cv2.IMREAD_COLOR
+    if REDUCED_DECODE and inference_size and header is not None and header[0] == 'jpeg':
+        # Mayor reducción que mantenga el lado largo (del recorte) >= resolución de la red
+        width, height = header[1], header[2]
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            # libjpeg redondea hacia arriba el tamaño reducido
+            reduced_width, reduced_height = -(-width // factor), -(-height // factor)
+            if roi is not None:
+                x1, y1, x2, y2 = roi_pixels(roi, reduced_width, reduced_height)
+                reduced_width, reduced_height = x2 - x1, y2 - y1
+            if max(reduced_width, reduced_height) >= inference_size:
+                flag = reduced_flag
+                break
+
+    with metrics.timed("decode"):
+        image = cv2.imdecode(nparr, flag)
+    if image is None or flag == cv2.IMREAD_COLOR:
+        return image, (1.0, 1.0)
+    return image, (header[1] / image.shape[1], header[2] / image.shape[0])
 
 def optimize_detection_for_3d_printing(model):
     """Optimizar configuración del modelo para detección de errores en impresión 3D"""
@@ -74,168 +782,935 @@ def optimize_detection_for_3d_printing(model):
     model.max_det = 1000
     return model
 
+def _hub_cache_dir(hub_ref):
+    """Directorio donde torch.hub guarda un repo ya descargado ('owner/repo:ref')"""
+    repo, _, ref = hub_ref.partition(':')
+    owner, name = repo.split('/')
+    return os.path.join(torch.hub.get_dir(), f"{owner}_{name}_{ref or 'master'}")
+
+def resolve_yolov5_source():
+    """Localiza el código de YOLOv5 sin tocar la red.
+
+    Orden: copia vendorizada (YOLOV5_REPO), caché de torch.hub de la referencia
+    fijada y, solo si ALLOW_MODEL_DOWNLOAD=1, descarga desde GitHub.
+    """
+    for directory in (YOLOV5_REPO, _hub_cache_dir(YOLOV5_HUB_REF)):
+        if os.path.isfile(os.path.join(directory, 'hubconf.py')):
+            return directory, 'local'
+
+    if ALLOW_MODEL_DOWNLOAD:
+        return YOLOV5_HUB_REF, 'github'
+
+    raise FileNotFoundError(
+        f"Código de YOLOv5 no encontrado en {YOLOV5_REPO} ni en la caché de torch.hub "
+        f"(ejecuta el buildCommand o define ALLOW_MODEL_DOWNLOAD=1)"
+    )
+
+@contextlib.contextmanager
+def trusted_checkpoint_load():
+    """torch.load con weights_only=False mientras se cargan nuestros propios pesos.
+
+    YOLOv5 v7.0 llama a torch.load sin indicar weights_only y desde torch 2.6
+    el valor por defecto es True, lo que impide deserializar el checkpoint
+    (guarda el modelo completo, no solo tensores). Usar únicamente con
+    ficheros de confianza como MODEL_PATH.
+    """
+    original_load = torch.load
+
+    def load(*args, **kwargs):
+        kwargs.setdefault('weights_only', False)
+        return original_load(*args, **kwargs)
+
+    torch.load = load
+    try:
+        yield
+    finally:
+        torch.load = original_load
+
+@functools.lru_cache(maxsize=None)
+def _load_yolov5(model_path):
+    """Carga (una sola vez por proceso) los pesos indicados"""
+    source, kind = resolve_yolov5_source()
+    logger.info(f"Usando YOLOv5 desde {source} ({kind})")
+    with trusted_checkpoint_load():
+        if kind == 'local':
+            return torch.hub.load(source, 'custom', path=model_path, source='local')
+        # Nunca forzar la recarga: si ya está en caché no se vuelve a descargar
+        return torch.hub.load(source, 'custom', path=model_path, force_reload=False,
+                              trust_repo=True, skip_validation=True)
+
+def resolve_model_path(backend=INFERENCE_BACKEND):
+    """Ruta de los pesos a cargar para el backend indicado"""
+    if backend not in BACKEND_MODEL_PATHS:
+        raise ValueError(f"Backend de inferencia desconocido: {backend} "
+                         f"(opciones: {', '.join(BACKEND_MODEL_PATHS)})")
+    return BACKEND_MODEL_PATHS[backend]
+
 # Cargar modelo al iniciar la aplicación
-def load_model():
+def load_model(model_path=None):
     try:
-        model_path = 'modelo/impresion.pt'
+        # El código de YOLOv5 (DetectMultiBackend + AutoShape) aplica el mismo
+        # preprocesado, NMS y nombres de clase a .pt, .onnx y OpenVINO
+        model_path = model_path or resolve_model_path()
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Modelo no encontrado en {model_path}")
         
         logger.info(f"Cargando modelo desde: {model_path}")
-        model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, force_reload=True)
+        start = time.perf_counter()
+        model = _load_yolov5(model_path)
         model = optimize_detection_for_3d_printing(model)
-        logger.info("Modelo cargado y optimizado correctamente")
+        elapsed = time.perf_counter() - start
+        metrics.MODEL_LOAD_SECONDS.set(elapsed)
+        logger.info(f"Modelo cargado y optimizado correctamente en {elapsed:.2f}s")
         return model
     except Exception as e:
         logger.error(f"Error al cargar el modelo: {str(e)}")
         return None
 
+def prepare_model_for_fork(model):
+    """Deja el modelo en modo solo lectura para compartirlo entre workers.
+
+    Se llama en el proceso maestro de gunicorn (preload_app) antes del fork:
+    sin gradientes ni cambios de modo, las páginas de los tensores no se
+    copian en los workers, y share_memory() las mueve a memoria compartida.
+    """
+    if model is None:
+        return None
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    model.share_memory()
+    return model
+
+class Overloaded(Exception):
+    """No hay capacidad para atender la inferencia a tiempo (se responde 503)"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+class MicroBatcher:
+    """Agrupa las llamadas concurrentes al modelo en una sola pasada de YOLOv5.
+
+    Cada petición deja su imagen en una cola; un hilo de fondo espera como
+    máximo `window_ms` a que lleguen más imágenes (hasta `max_size`), ejecuta
+    una única inferencia sobre el lote y devuelve a cada llamante su propio
+    objeto de resultados.
+
+    La cola tiene control de admisión: si ya hay `max_depth` imágenes
+    esperando, o una imagen lleva más de `deadline` segundos en la cola, se
+    lanza Overloaded con una estimación de cuándo reintentar. Una petición
+    que por sí sola supera `max_depth` no cabrá nunca y se rechaza con 413.
+    """
+
+    def __init__(self, model, window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE, size=INFERENCE_SIZE,
+                 max_depth=ADMISSION_MAX_DEPTH, deadline=ADMISSION_DEADLINE):
+        self.model = model
+        self.size = size
+        self.window = window_ms / 1000.0
+        self.max_size = max(1, max_size)
+        self.max_depth = max_depth
+        self.deadline = deadline
+        self._queue = queue.Queue()
+        self._depth = 0
+        self._batch_seconds = 0.0  # Media móvil de la duración de un lote
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        # El hilo se arranca de forma perezosa (y se rearranca tras un fork)
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._depth = 0
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    @property
+    def depth(self):
+        """Imágenes esperando en la cola"""
+        return self._depth
+
+    def retry_after(self):
+        """Segundos estimados hasta que la cola actual se haya vaciado"""
+        batches = self._depth / self.max_size + 1
+        return max(ADMISSION_RETRY_AFTER, math.ceil(batches * self._batch_seconds))
+
+    def check_capacity(self, count=1):
+        """Lanza Overloaded si no caben `count` imágenes más en la cola"""
+        if self.max_depth and count > self.max_depth:
+            # Reintentar no serviría de nada: es un error permanente, no saturación
+            raise InputError(f"La petición necesita {count} inferencias y el máximo es {self.max_depth} "
+                             f"(menos imágenes por lote o menos tiles)", 413)
+        if self.max_depth and self._depth + count > self.max_depth:
+            raise Overloaded("Servidor saturado, reintentar más tarde", self.retry_after())
+
+    def submit_many(self, images):
+        """Encola varias imágenes (todas o ninguna) y devuelve sus Futures"""
+        self._ensure_worker()
+        expires = time.monotonic() + self.deadline if self.deadline else None
+        with self._lock:
+            self.check_capacity(len(images))
+            self._depth += len(images)
+            metrics.INFERENCE_QUEUE_DEPTH.set(self._depth)
+
+        futures = []
+        for image in images:
+            future = Future()
+            self._queue.put((image, future, expires))
+            futures.append(future)
+        return futures
+
+    def submit(self, image):
+        """Encola una imagen y devuelve un Future con sus resultados"""
+        return self.submit_many([image])[0]
+
+    def infer(self, image):
+        """Inferencia bloqueante de una sola imagen"""
+        return self.submit(image).result()
+
+    def infer_many(self, images):
+        """Inferencia bloqueante de varias imágenes (se reparten en lotes)"""
+        return [future.result() for future in self.submit_many(images)]
+
+    def _take(self, timeout=None):
+        """Saca un elemento de la cola descartando los que ya no llegan a tiempo"""
+        while True:
+            image, future, expires = self._queue.get(timeout=timeout)
+            with self._lock:
+                self._depth -= 1
+                metrics.INFERENCE_QUEUE_DEPTH.set(self._depth)
+            if expires is None or time.monotonic() <= expires:
+                return image, future
+            future.set_exception(Overloaded("Tiempo de espera de inferencia agotado", self.retry_after()))
+
+    def _collect_batch(self):
+        batch = [self._take()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._take(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            images = [image for image, _ in batch]
+            metrics.BATCH_SIZE.observe(len(images))
+            start = time.perf_counter()
+            try:
+                with metrics.timed("inference"):
+                    results = self.model(images, size=self.size).tolist()
+            except Exception as e:
+                logger.error(f"Error en inferencia por lotes: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            elapsed = time.perf_counter() - start
+            self._batch_seconds = elapsed if not self._batch_seconds else 0.8 * self._batch_seconds + 0.2 * elapsed
+            if len(batch) > 1:
+                logger.info(f"Lote de inferencia procesado: {len(batch)} imágenes")
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+def frame_hash(image):
+    """dHash de 64 bits: compara píxeles vecinos de la imagen en gris reducida a 9x8"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+class ResultCache:
+    """Últimos resultados de inferencia por impresora, reutilizados si la escena no cambia.
+
+    Cada impresora guarda el hash perceptual del último fotograma que pasó
+    por el modelo junto con sus resultados. Un fotograma nuevo cuyo hash
+    difiere en como mucho `max_distance` bits (y con el mismo tamaño)
+    reutiliza esos resultados mientras no pase `ttl` desde la inferencia. Los
+    aciertos no renuevan la entrada, de modo que un cambio lento de la escena
+    acaba forzando una inferencia nueva. Se descartan las impresoras menos
+    usadas recientemente cuando hay más de `max_printers`.
+    """
+
+    def __init__(self, max_printers=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, max_distance=RESULT_CACHE_MAX_DISTANCE):
+        self.max_printers = max_printers
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, printer_id, image_hash, shape, now=None):
+        """Resultados guardados para un fotograma equivalente, o None"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(printer_id)
+            if entry is None:
+                return None
+            cached_hash, cached_shape, stored_at, results = entry
+            if now - stored_at > self.ttl:
+                del self._entries[printer_id]
+                return None
+            self._entries.move_to_end(printer_id)
+            if cached_shape != shape or (cached_hash ^ image_hash).bit_count() > self.max_distance:
+                return None
+            return results
+
+    def put(self, printer_id, image_hash, shape, results, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[printer_id] = (image_hash, shape, now, results)
+            self._entries.move_to_end(printer_id)
+            while len(self._entries) > self.max_printers:
+                self._entries.popitem(last=False)
+
+class RoiStore:
+    """Regiones de interés (zona de la cama de impresión) de cada impresora.
+
+    Se leen de un JSON {"id_impresora": [x1, y1, x2, y2]} con coordenadas en
+    fracciones del fotograma (0-1), independientes de la resolución enviada.
+    El fichero se vuelve a leer cuando cambia su fecha de modificación, así
+    que todos los workers ven los cambios sin reiniciar. Las entradas no
+    válidas se ignoran con un aviso.
+    """
+
+    def __init__(self, path=ROI_CONFIG_PATH):
+        self.path = path
+        self._regions = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse(roi):
+        """Valida una ROI y la devuelve como tupla de floats"""
+        x1, y1, x2, y2 = (float(v) for v in roi)
+        if not (0 <= x1 < x2 <= 1 and 0 <= y1 < y2 <= 1):
+            raise ValueError(f"ROI fuera de rango: {roi}")
+        return x1, y1, x2, y2
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+
+        regions = {}
+        if mtime is not None:
+            try:
+                with open(self.path) as f:
+                    config = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"No se pudo leer {self.path}: {e}")
+                config = {}
+            if not isinstance(config, dict):
+                logger.error(f"{self.path} debe contener un objeto JSON {{\"id\": [x1, y1, x2, y2]}}")
+                config = {}
+            for printer_id, roi in config.items():
+                try:
+                    regions[printer_id] = self.parse(roi)
+                except (TypeError, ValueError) as e:
+                    logger.warning(f"ROI no válida para {printer_id}: {e}")
+            logger.info(f"ROIs cargadas para {len(regions)} impresoras")
+        self._regions = regions
+        self._mtime = mtime
+
+    def get(self, printer_id):
+        """ROI de la impresora en fracciones del fotograma, o None si no tiene"""
+        with self._lock:
+            self._refresh()
+            return self._regions.get(printer_id)
+
+def roi_pixels(roi, width, height):
+    """ROI en fracciones -> (x1, y1, x2, y2) en píxeles de una imagen de width x height"""
+    x1, y1 = int(roi[0] * width), int(roi[1] * height)
+    x2 = max(x1 + 1, int(math.ceil(roi[2] * width)))
+    y2 = max(y1 + 1, int(math.ceil(roi[3] * height)))
+    return x1, y1, min(x2, width), min(y2, height)
+
+def tile_windows(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, include_full=TILE_INCLUDE_FULL):
+    """Ventanas (x1, y1, x2, y2) que cubren la imagen con tiles solapados.
+
+    Los tiles de cada eje se reparten uniformemente entre los dos bordes,
+    con al menos `overlap` de solape entre vecinos. Con `include_full` la
+    primera ventana es la imagen completa y se omite cualquier tile que
+    coincida con ella (imagen no mayor que un tile).
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        shared = int(tile_size * overlap)
+        count = math.ceil((length - shared) / max(1, tile_size - shared))
+        stride = (length - tile_size) / (count - 1)
+        return [round(i * stride) for i in range(count)]
+
+    full = (0, 0, width, height)
+    windows = [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+               for y in starts(height) for x in starts(width)]
+    if include_full:
+        windows = [full] + [window for window in windows if window != full]
+    return windows
+
+def non_max_suppression(boxes, iou_thres=TILE_NMS_IOU):
+    """NMS por clase sobre un array (N, 6) x1, y1, x2, y2, confianza, clase"""
+    order = np.argsort(-boxes[:, 4])
+    boxes = boxes[order]
+    keep = np.ones(len(boxes), dtype=bool)
+    for i in range(len(boxes)):
+        if not keep[i]:
+            continue
+        rest = np.arange(i + 1, len(boxes))
+        rest = rest[keep[rest] & (boxes[rest, 5] == boxes[i, 5])]
+        if rest.size:
+            keep[rest[box_iou(boxes[i], boxes[rest]) > iou_thres]] = False
+    return boxes[keep]
+
+def merge_tile_detections(tile_results, windows, iou_thres=TILE_NMS_IOU):
+    """Detecciones de cada tile -> detecciones de la imagen completa tras NMS entre tiles"""
+    parts = [DetectionResult.from_results(results).translate(x1, y1)
+             for results, (x1, y1, _, _) in zip(tile_results, windows)]
+    boxes = np.concatenate([part.boxes for part in parts])
+    return DetectionResult(non_max_suppression(boxes, iou_thres), parts[0].names)
+
+def draw_detections(image, detections):
+    """Dibuja las cajas y etiquetas sobre una copia de la imagen (render de los tiles)"""
+    canvas = image.copy()
+    for (x1, y1, x2, y2, confidence, _), name in zip(detections.boxes, detections.labels):
+        color = (0, 200, 0) if name.lower() == NORMAL_CLASS else (0, 0, 255)
+        top_left, bottom_right = (int(x1), int(y1)), (int(x2), int(y2))
+        cv2.rectangle(canvas, top_left, bottom_right, color, 2)
+        cv2.putText(canvas, f"{name} {confidence:.2f}", (int(x1), max(int(y1) - 5, 12)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+    return canvas
+
+class InputError(Exception):
+    """Error en los datos de entrada de una petición (se responde con `status`)"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def check_image_header(data):
+    """Rechaza con 413 las imágenes cuya cabecera supera MAX_IMAGE_PIXELS.
+
+    Devuelve la cabecera (o None si aún no se reconoce) para reutilizarla.
+    """
+    header = read_image_header(data)
+    if image_too_large(header):
+        raise InputError(f"Imagen demasiado grande: {header[1]}x{header[2]} píxeles "
+                         f"(máximo {MAX_IMAGE_PIXELS})", 413)
+    return header
+
+def read_body(stream, content_length, chunk_size=1024 * 1024):
+    """Lee el cuerpo en un buffer reservado, comprobando la cabecera de la imagen al principio.
+
+    La cabecera se valida con los primeros HEADER_PROBE_BYTES, antes de leer
+    el resto, para cortar pronto los fotogramas con demasiados píxeles.
+    """
+    if content_length is None:
+        # Sin Content-Length (chunked): lectura por bloques, limitada por MAX_CONTENT_LENGTH
+        head = stream.read(HEADER_PROBE_BYTES)
+        check_image_header(head)
+        return head + stream.read()
+
+    buffer = bytearray(content_length)
+    view = memoryview(buffer)
+    size = 0
+    checked = False
+    while size < content_length:
+        limit = HEADER_PROBE_BYTES if not checked else chunk_size
+        chunk = stream.read(min(limit, content_length - size))
+        if not chunk:
+            break
+        view[size:size + len(chunk)] = chunk
+        size += len(chunk)
+        if not checked and (size >= HEADER_PROBE_BYTES or size == content_length):
+            check_image_header(view[:size])
+            checked = True
+    return view[:size]
+
+class Frame:
+    """Estado de un fotograma a lo largo de las etapas del pipeline"""
+
+    def __init__(self, image_bytes, printer_id=DEFAULT_PRINTER_ID, name=None):
+        self.image_bytes = image_bytes
+        self.printer_id = printer_id
+        self.name = name
+        self.image = None
+        self.scale = (1.0, 1.0)
+        self.roi = None
+        self.offset = (0, 0)
+        self.tiles = None
+        self.tile_detections = None
+        self.hash = None
+        self.cached = False
+        self.results = None
+        self.detections = None
+        self.response = None
+
+class DetectionPipeline:
+    """Pipeline de detección común a todas las rutas de entrada.
+
+    Etapas: decode -> preprocess -> lookup (caché) -> infer -> postprocess ->
+    alert. Las rutas solo aportan un adaptador que extrae los bytes de la
+    imagen de la petición; todo lo demás (recorte a la ROI, caché, batching,
+    escalado, alertas) se aplica igual a cualquier forma de envío.
+    """
+
+    def __init__(self, batcher, dispatcher, suppressor, cache=None, rois=None, tiled=TILED_INFERENCE, tracker=None):
+        self.batcher = batcher
+        self.dispatcher = dispatcher
+        self.suppressor = suppressor
+        self.tracker = tracker
+        self.cache = cache
+        self.rois = rois
+        self.tiled = tiled
+
+    def decode(self, frame):
+        """Bytes -> imagen BGR (a escala reducida si procede)"""
+        header = check_image_header(frame.image_bytes)
+        frame.roi = self.rois.get(frame.printer_id) if self.rois is not None else None
+        # Los tiles se toman de la imagen a resolución completa
+        inference_size = None if self.tiled else INFERENCE_SIZE
+        frame.image, frame.scale = decode_image(frame.image_bytes, inference_size,
+                                                header=header, roi=frame.roi)
+        if frame.image is None:
+            raise InputError("No se pudo decodificar la imagen")
+        # Los bytes ya no se necesitan; liberarlos pronto reduce la memoria por petición
+        frame.image_bytes = None
+
+    def preprocess(self, frame):
+        """Recorta la imagen a la ROI de la impresora y, en modo tiles, calcula las ventanas"""
+        if frame.roi is not None:
+            height, width = frame.image.shape[:2]
+            x1, y1, x2, y2 = roi_pixels(frame.roi, width, height)
+            # Copia contigua: el modelo procesa menos píxeles y la imagen completa se libera
+            frame.image = np.ascontiguousarray(frame.image[y1:y2, x1:x2])
+            frame.offset = (x1, y1)
+        if self.tiled:
+            height, width = frame.image.shape[:2]
+            frame.tiles = tile_windows(width, height)
+
+    def lookup(self, frame):
+        """Reutiliza los resultados de la caché si el fotograma apenas cambió"""
+        if self.cache is None:
+            return
+        frame.hash = frame_hash(frame.image)
+        frame.results = self.cache.get(frame.printer_id, frame.hash, frame.image.shape)
+        frame.cached = frame.results is not None
+        metrics.RESULT_CACHE.labels("hit" if frame.cached else "miss").inc()
+
+    def infer(self, frames):
+        """Inferencia de varios fotogramas (o de todos sus tiles) a través del micro-batcher"""
+        images = []
+        for frame in frames:
+            if frame.tiles is None:
+                images.append(frame.image)
+            else:
+                images.extend(frame.image[y1:y2, x1:x2] for x1, y1, x2, y2 in frame.tiles)
+
+        results = iter(self.batcher.infer_many(images))
+        for frame in frames:
+            if frame.tiles is None:
+                frame.results = next(results)
+            else:
+                frame.results = [next(results) for _ in frame.tiles]
+            if self.cache is not None:
+                self.cache.put(frame.printer_id, frame.hash, frame.image.shape, frame.results)
+
+    def postprocess(self, frame):
+        """Resultados del modelo -> detecciones en coordenadas del fotograma original"""
+        with metrics.timed("postprocess"):
+            self._postprocess(frame)
+        metrics.count_detections(frame.detections.labels.tolist())
+
+    def _postprocess(self, frame):
+        if frame.tiles is None:
+            detections = DetectionResult.from_results(frame.results)
+        else:
+            detections = frame.tile_detections = merge_tile_detections(frame.results, frame.tiles)
+        detections = detections.translate(*frame.offset).rescale(*frame.scale)
+        frame.detections = detections
+        frame.response = {
+            "detections_found": len(detections),
+            "detections": detections.to_json(),
+            "alert_sent": False,
+            "status": "normal",
+            "cached": frame.cached
+        }
+
+    def alert(self, frame):
+        """Decide el estado (del fotograma o de la secuencia) y encola la alerta si corresponde"""
+        response_data = frame.response
+        frame_errors = frame.detections.errors().labels.tolist()
+        if self.tracker is None:
+            status = classify_status(frame.detections)
+            error_classes = frame_errors
+            response_data["next_interval"] = suggest_interval(status, status)
+        else:
+            # Estado de la secuencia de la impresora: los errores ya vienen confirmados
+            temporal = self.tracker.update(frame.printer_id, frame.detections)
+            response_data["temporal"] = temporal
+            status, error_classes = temporal["status"], temporal["error_classes"]
+            response_data["next_interval"] = suggest_interval(status, temporal["frame_status"],
+                                                              temporal["error_ratio"])
+
+        # Registrar el fotograma aunque no tenga errores (confirmación N de M). Solo
+        # se alerta de clases visibles en este fotograma, que es el que se envía
+        visible_errors = [name for name in error_classes if name in frame_errors]
+        should_alert, reason = self.suppressor.check(frame.printer_id, visible_errors,
+                                                     confirmed=self.tracker is not None)
+
+        if status == "normal":
+            return
+
+        if status == "error_pending":
+            response_data["status"] = "error_pending"
+            response_data["alert_suppressed"] = "pending_confirmation"
+            metrics.ALERTS.labels("pending_confirmation").inc()
+            logger.info(f"Posible error en {frame.printer_id}, pendiente de confirmación")
+        elif status == "error_detected":
+            response_data["status"] = "error_detected"
+            logger.info(f"Errores detectados: {len(error_classes)} tipos")
+            if should_alert:
+                # Solo se renderiza y codifica la imagen si la alerta se va a enviar
+                with metrics.timed("render"):
+                    if frame.tiles is None:
+                        rendered_image = np.squeeze(frame.results.render())
+                    else:
+                        rendered_image = draw_detections(frame.image, frame.tile_detections)
+                alert_id, alert_state = self.dispatcher.submit(rendered_image, frame.detections)
+                response_data["alert_sent"] = alert_state
+                response_data["alert_id"] = alert_id
+            else:
+                if not visible_errors:
+                    # Error confirmado por la secuencia que ya no aparece en este fotograma
+                    reason = "not_in_frame"
+                response_data["alert_suppressed"] = reason
+                metrics.ALERTS.labels(reason).inc()
+                logger.info(f"Alerta suprimida para {frame.printer_id}: {reason}")
+        else:
+            response_data["status"] = "printing_normal"
+            logger.info("Solo se detectó 'imprimiendo' - Estado normal")
+
+    def run(self, frame):
+        """Procesa un fotograma y devuelve la respuesta JSON (InputError si es inválido)"""
+        return self.run_many([frame], strict=True)[0]
+
+    def run_many(self, frames, strict=False):
+        """Procesa varios fotogramas en una sola tanda de inferencia.
+
+        Sin `strict`, los fotogramas que no se pueden decodificar reciben su
+        propia respuesta de error y no detienen al resto.
+        """
+        valid = []
+        for frame in frames:
+            try:
+                self.decode(frame)
+                self.preprocess(frame)
+                valid.append(frame)
+            except InputError as e:
+                if strict:
+                    raise
+                frame.response = {"error": e.message}
+
+        for frame in valid:
+            self.lookup(frame)
+        pending = [frame for frame in valid if not frame.cached]
+        if pending:
+            self.infer(pending)
+        for frame in valid:
+            self.postprocess(frame)
+            self.alert(frame)
+
+        for frame in frames:
+            if frame.name is not None:
+                frame.response["filename"] = frame.name
+        return [frame.response for frame in frames]
+
+class Base64StreamDecoder:
+    """Extrae y decodifica en streaming la imagen base64 de un JSON {"image": "..."}.
+
+    Se alimenta con bloques del cuerpo de la petición: localiza la clave
+    "image", salta el prefijo data URI si lo hay y decodifica el base64 por
+    grupos de 4 caracteres directamente en un buffer reservado de antemano
+    (3/4 del tamaño del cuerpo). Así no se crean copias completas del JSON,
+    de la cadena ni de los bytes decodificados. El resto del JSON se ignora.
+    """
+
+    _KEY = re.compile(rb'"image"\s*:\s*"')
+    _WHITESPACE = b' \t\r\n'
+
+    def __init__(self, size_hint=None):
+        self._out = bytearray(size_hint * 3 // 4 + 4 if size_hint else 1 << 20)
+        self._size = 0
+        self._state = 'key'
+        self._pending = b''
+        self._carry = b''
+        self.done = False
+
+    def feed(self, chunk):
+        """Procesa un bloque del cuerpo; devuelve True cuando la imagen está completa"""
+        data = self._pending + bytes(chunk)
+        self._pending = b''
+
+        if self._state == 'key':
+            match = self._KEY.search(data)
+            if match is None:
+                # Conservar el final por si la clave queda partida entre bloques
+                self._pending = data[-32:]
+                return False
+            data = data[match.end():]
+            self._state = 'prefix'
+
+        if self._state == 'prefix':
+            if len(data) < 5 and b'"' not in data:
+                self._pending = data
+                return False
+            if data.startswith(b'data:'):
+                comma = data.find(b',')
+                if comma < 0:
+                    if len(data) > 256:
+                        raise InputError("Prefijo data URI inválido")
+                    self._pending = data
+                    return False
+                data = data[comma + 1:]
+            self._state = 'data'
+
+        end = data.find(b'"')
+        if end >= 0:
+            data = data[:end]
+            self.done = True
+
+        if b'\\' in data:
+            # Secuencias de escape JSON (p. ej. "\/" o saltos de línea "\n")
+            if data.endswith(b'\\') and not self.done:
+                data, self._pending = data[:-1], b'\\'
+            data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        # Base64 pendiente del bloque anterior (grupo de 4 caracteres incompleto)
+        data = self._carry + data.translate(None, self._WHITESPACE)
+
+        usable = len(data) if self.done else len(data) - len(data) % 4
+        self._carry = data[usable:]
+        if usable:
+            self._write(data[:usable])
+        return self.done
+
+    def _write(self, encoded):
+        try:
+            decoded = binascii.a2b_base64(encoded)
+        except binascii.Error as e:
+            raise InputError(f"Error al decodificar imagen base64: {str(e)}")
+
+        end = self._size + len(decoded)
+        if end > len(self._out):
+            self._out.extend(bytes(max(end - len(self._out), len(self._out))))
+        self._out[self._size:end] = decoded
+        self._size = end
+
+    @property
+    def decoded_size(self):
+        return self._size
+
+    def result(self):
+        """Bytes decodificados hasta ahora (vista sobre el buffer, sin copia)"""
+        return memoryview(self._out)[:self._size]
+
+def decode_base64_stream(stream, content_length=None, chunk_size=BASE64_CHUNK_SIZE):
+    """Lee el cuerpo por bloques y devuelve la imagen decodificada"""
+    decoder = Base64StreamDecoder(content_length)
+    checked = False
+    while not decoder.done:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        decoder.feed(chunk)
+        # Validar la cabecera en cuanto se ha decodificado lo suficiente
+        if not checked and (decoder.decoded_size >= HEADER_PROBE_BYTES or decoder.done):
+            check_image_header(decoder.result())
+            checked = True
+
+    if not decoder.done:
+        raise InputError("No se envió imagen en base64")
+
+    # Descartar el resto del cuerpo para no dejar datos sin leer en la conexión
+    while stream.read(chunk_size):
+        pass
+    return decoder.result()
+
+# Adaptadores de entrada: extraen los fotogramas de cada tipo de petición
+
+def read_multipart_frame(req):
+    """Imagen enviada como multipart/form-data en el campo 'image'"""
+    with metrics.timed("body_read"):
+        if 'image' not in req.files:
+            raise InputError("No se envió ninguna imagen")
+
+        file = req.files['image']
+        if file.filename == '':
+            raise InputError("Archivo vacío")
+        return Frame(file.read(), get_printer_id())
+
+def read_raw_frame(req):
+    """Imagen enviada directamente como cuerpo (Content-Type: image/jpeg o image/png).
+
+    No pasa por el parser multipart de Werkzeug: el cuerpo se lee en un
+    buffer reservado y decode_image lo envuelve con np.frombuffer sin copiarlo.
+    """
+    with metrics.timed("body_read"):
+        image_bytes = read_body(req.stream, req.content_length)
+    if not image_bytes:
+        raise InputError("Cuerpo de la petición vacío")
+    return Frame(image_bytes, get_printer_id())
+
+def read_detect_frame(req):
+    """Adaptador de /detect: cuerpo binario si el Content-Type es una imagen, si no multipart"""
+    if req.mimetype in RAW_IMAGE_TYPES:
+        return read_raw_frame(req)
+    return read_multipart_frame(req)
+
+def read_multipart_frames(req):
+    """Varias imágenes multipart (partes 'image') en una sola petición"""
+    with metrics.timed("body_read"):
+        files = req.files.getlist('image')
+        if not files:
+            raise InputError("No se envió ninguna imagen")
+
+        printer_id = get_printer_id()
+        return [Frame(file.read(), get_part_printer_id(file, printer_id), name=file.filename)
+                for file in files]
+
+def read_base64_frame(req):
+    """Imagen en base64 (opcionalmente como data URI) en el JSON {'image': ...}"""
+    if not req.is_json:
+        raise InputError("No se envió imagen en base64")
+
+    with metrics.timed("body_read"):
+        image_data = decode_base64_stream(req.stream, req.content_length)
+    return Frame(image_data, get_printer_id())
+
+def get_printer_id():
+    """Identificador de la impresora que envía la petición actual"""
+    return request.headers.get(PRINTER_ID_HEADER, DEFAULT_PRINTER_ID).strip() or DEFAULT_PRINTER_ID
+
+def get_part_printer_id(part, default):
+    """Impresora de una parte multipart de /detect_batch.
+
+    Un lote puede mezclar fotogramas de varias impresoras: cada parte lleva
+    entonces su propia cabecera X-Printer-ID, para que el seguimiento, la
+    supresión de alertas, la caché y la ROI sean los de su impresora. Sin
+    ella se usa la impresora de la petición.
+    """
+    return (part.headers.get(PRINTER_ID_HEADER) or '').strip() or default
+
+# Repartir los núcleos entre workers antes de cargar el modelo
+configure_threads()
+
 # Cargar modelo globalmente
 model = load_model()
+batcher = MicroBatcher(model) if model is not None else None
+result_cache = ResultCache() if RESULT_CACHE_SIZE > 0 else None
+roi_store = RoiStore()
+temporal_tracker = TemporalTracker() if TEMPORAL_SMOOTHING else None
+pipeline = (DetectionPipeline(batcher, alert_dispatcher, alert_suppressor, result_cache, roi_store,
+                              tracker=temporal_tracker)
+            if model is not None else None)
 
-@app.route('/', methods=['GET'])
-def health_check():
-    """Endpoint de verificación de salud"""
-    status = "OK" if model is not None else "ERROR"
-    return jsonify({
-        "status": status,
+def health_status():
+    """Estado del servidor (común a las variantes WSGI y ASGI)"""
+    return {
+        "status": "OK" if model is not None else "ERROR",
         "message": "Servidor de detección de errores en impresión 3D",
-        "model_loaded": model is not None
-    })
+        "model_loaded": model is not None,
+        "backend": INFERENCE_BACKEND
+    }
 
-@app.route('/detect', methods=['POST'])
-def detect_errors():
-    """Endpoint principal para detección de errores"""
+def batch_response(frames, responses):
+    """Respuesta de /detect_batch a partir de las respuestas de cada fotograma"""
+    return {
+        "images_received": len(frames),
+        "images_processed": sum(1 for r in responses if "error" not in r),
+        "results": responses
+    }
+
+def overloaded_response(e):
+    """Cuerpo y cabeceras de la respuesta 503 cuando la cola de inferencia está llena"""
+    return {"error": e.message, "retry_after": e.retry_after}, {"Retry-After": str(e.retry_after)}
+
+def handle_detection(process, description):
+    """Ejecuta `process(request)` con el manejo de errores común a las rutas de detección"""
     try:
-        if model is None:
+        if pipeline is None:
             return jsonify({"error": "Modelo no disponible"}), 500
-        
-        # Verificar que se envió una imagen
-        if 'image' not in request.files:
-            return jsonify({"error": "No se envió ninguna imagen"}), 400
-        
-        file = request.files['image']
-        if file.filename == '':
-            return jsonify({"error": "Archivo vacío"}), 400
-        
-        # Leer y procesar la imagen
-        image_bytes = file.read()
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return jsonify({"error": "No se pudo decodificar la imagen"}), 400
-        
-        # Realizar detección
-        results = model(image)
-        detections = results.pandas().xyxy[0]
-        
-        # Procesar resultados
-        response_data = {
-            "detections_found": len(detections),
-            "detections": [],
-            "alert_sent": False,
-            "status": "normal"
-        }
-        
-        if len(detections) > 0:
-            # Convertir detecciones a formato JSON serializable
-            for _, row in detections.iterrows():
-                detection = {
-                    "name": row['name'],
-                    "confidence": float(row['confidence']),
-                    "coordinates": {
-                        "xmin": int(row['xmin']),
-                        "ymin": int(row['ymin']),
-                        "xmax": int(row['xmax']),
-                        "ymax": int(row['ymax'])
-                    }
-                }
-                response_data["detections"].append(detection)
-            
-            # Verificar si hay errores (excluyendo 'imprimiendo')
-            error_detections = detections[detections['name'].str.lower() != 'imprimiendo']
-            
-            if not error_detections.empty:
-                # Hay errores, enviar alerta
-                rendered_image = np.squeeze(results.render())
-                alert_sent = send_telegram_alert(rendered_image, detections)
-                response_data["alert_sent"] = alert_sent
-                response_data["status"] = "error_detected"
-                logger.info(f"Errores detectados: {len(error_detections)} tipos")
-            else:
-                response_data["status"] = "printing_normal"
-                logger.info("Solo se detectó 'imprimiendo' - Estado normal")
-        
-        return jsonify(response_data)
-        
+
+        # Rechazo rápido, antes de leer el cuerpo, si la cola ya está llena
+        batcher.check_capacity()
+        return jsonify(process(request))
+
+    except Overloaded as e:
+        body, headers = overloaded_response(e)
+        return jsonify(body), 503, headers
+    except InputError as e:
+        return jsonify({"error": e.message}), e.status
+    except HTTPException:
+        # 413 de Werkzeug (MAX_CONTENT_LENGTH) y demás errores HTTP
+        raise
     except Exception as e:
-        logger.error(f"Error en detección: {str(e)}")
+        logger.error(f"Error en {description}: {str(e)}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
+@app.errorhandler(413)
+def request_too_large(e):
+    """Respuesta JSON cuando el cuerpo supera MAX_CONTENT_LENGTH"""
+    return jsonify({"error": f"Petición demasiado grande (máximo {MAX_UPLOAD_BYTES} bytes)"}), 413
+
+@app.route('/', methods=['GET'])
+def health_check():
+    """Endpoint de verificación de salud"""
+    return jsonify(health_status())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas en formato de exposición de Prometheus"""
+    body, content_type = metrics.render_metrics()
+    return body, 200, {"Content-Type": content_type}
+
+@app.route('/alerts/<alert_id>', methods=['GET'])
+def alert_status(alert_id):
+    """Consulta el estado de una alerta encolada"""
+    status = alert_dispatcher.status(alert_id)
+    if status is None:
+        return jsonify({"error": "Alerta no encontrada"}), 404
+    return jsonify(status)
+
+@app.route('/detect', methods=['POST'])
+def detect_errors():
+    """Endpoint principal para detección de errores (multipart o imagen binaria)"""
+    return handle_detection(lambda req: pipeline.run(read_detect_frame(req)), "detección")
+
+@app.route('/detect_batch', methods=['POST'])
+def detect_errors_batch():
+    """Endpoint que acepta varias imágenes (partes 'image') en una sola petición"""
+    def process(req):
+        frames = read_multipart_frames(req)
+        return batch_response(frames, pipeline.run_many(frames))
+    return handle_detection(process, "detección por lotes")
+
 @app.route('/detect_base64', methods=['POST'])
 def detect_errors_base64():
     """Endpoint alternativo que acepta imágenes en base64"""
-    try:
-        if model is None:
-            return jsonify({"error": "Modelo no disponible"}), 500
-        
-        data = request.get_json()
-        if not data or 'image' not in data:
-            return jsonify({"error": "No se envió imagen en base64"}), 400
-        
-        # Decodificar imagen base64
-        try:
-            image_data = base64.b64decode(data['image'].split(',')[1] if ',' in data['image'] else data['image'])
-            nparr = np.frombuffer(image_data, np.uint8)
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        except Exception as e:
-            return jsonify({"error": f"Error al decodificar imagen base64: {str(e)}"}), 400
-        
-        if image is None:
-            return jsonify({"error": "No se pudo decodificar la imagen"}), 400
-        
-        # Realizar detección (mismo código que el endpoint anterior)
-        results = model(image)
-        detections = results.pandas().xyxy[0]
-        
-        response_data = {
-            "detections_found": len(detections),
-            "detections": [],
-            "alert_sent": False,
-            "status": "normal"
-        }
-        
-        if len(detections) > 0:
-            for _, row in detections.iterrows():
-                detection = {
-                    "name": row['name'],
-                    "confidence": float(row['confidence']),
-                    "coordinates": {
-                        "xmin": int(row['xmin']),
-                        "ymin": int(row['ymin']),
-                        "xmax": int(row['xmax']),
-                        "ymax": int(row['ymax'])
-                    }
-                }
-                response_data["detections"].append(detection)
-            
-            error_detections = detections[detections['name'].str.lower() != 'imprimiendo']
-            
-            if not error_detections.empty:
-                rendered_image = np.squeeze(results.render())
-                alert_sent = send_telegram_alert(rendered_image, detections)
-                response_data["alert_sent"] = alert_sent
-                response_data["status"] = "error_detected"
-            else:
-                response_data["status"] = "printing_normal"
-        
-        return jsonify(response_data)
-        
-    except Exception as e:
-        logger.error(f"Error en detección base64: {str(e)}")
-        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+    return handle_detection(lambda req: pipeline.run(read_base64_frame(req)), "detección base64")
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,200 @@
+"""Variante ASGI del servidor de detección (mismas rutas y mismo JSON que app.py).
+
+La E/S es asíncrona: las subidas lentas de las Raspberry Pi solo ocupan una
+corrutina mientras llegan los bytes, no un worker. La decodificación y la
+inferencia (pipeline de app.py) se ejecutan en un pool de hilos acotado, de
+modo que puede haber miles de clientes conectados mientras la carga de CPU
+sigue limitada por INFERENCE_WORKERS y el micro-batcher.
+
+Uso:
+    uvicorn app_asgi:app --host 0.0.0.0 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker app_asgi:app
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import app as core
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Hilos que ejecutan decode + inferencia; con el micro-batcher basta con
+# poder llenar un lote, más hilos solo aumentarían la cola en memoria
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(core.BATCH_MAX_SIZE)))
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+def get_printer_id(request):
+    """Identificador de la impresora que envía la petición"""
+    return request.headers.get(core.PRINTER_ID_HEADER, core.DEFAULT_PRINTER_ID).strip() or core.DEFAULT_PRINTER_ID
+
+def too_large():
+    return core.InputError(f"Petición demasiado grande (máximo {core.MAX_UPLOAD_BYTES} bytes)", 413)
+
+def check_content_length(request):
+    """Rechaza con 413 antes de leer nada si el Content-Length supera el límite"""
+    content_length = request.headers.get('content-length')
+    length = int(content_length) if content_length and content_length.isdigit() else None
+    if length is not None and length > core.MAX_UPLOAD_BYTES:
+        raise too_large()
+    return length
+
+async def run_inference(func, *args):
+    """Ejecuta una función bloqueante del pipeline en el pool de inferencia"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, func, *args)
+
+async def read_body(request):
+    """Lee el cuerpo sin bloquear, con los mismos límites de bytes y píxeles que app.py"""
+    length = check_content_length(request)
+    buffer = bytearray(length) if length is not None else bytearray()
+    size = 0
+    checked = False
+
+    async for chunk in request.stream():
+        if not chunk:
+            continue
+        if size + len(chunk) > core.MAX_UPLOAD_BYTES:
+            raise too_large()
+        if length is not None:
+            if size + len(chunk) > length:
+                raise core.InputError("El cuerpo supera el Content-Length declarado")
+            buffer[size:size + len(chunk)] = chunk
+        else:
+            buffer += chunk
+        size += len(chunk)
+
+        if not checked and size >= core.HEADER_PROBE_BYTES:
+            core.check_image_header(bytes(buffer[:core.HEADER_PROBE_BYTES]))
+            checked = True
+
+    return memoryview(buffer)[:size]
+
+async def read_raw_frame(request):
+    """Imagen binaria en el cuerpo (Content-Type: image/jpeg o image/png)"""
+    image_bytes = await read_body(request)
+    if not image_bytes:
+        raise core.InputError("Cuerpo de la petición vacío")
+    return core.Frame(image_bytes, get_printer_id(request))
+
+async def read_multipart_files(request):
+    check_content_length(request)
+    form = await request.form()
+    return [part for part in form.getlist('image') if hasattr(part, 'read')]
+
+async def read_multipart_frame(request):
+    """Imagen multipart en el campo 'image'"""
+    files = await read_multipart_files(request)
+    if not files:
+        raise core.InputError("No se envió ninguna imagen")
+    if files[0].filename == '':
+        raise core.InputError("Archivo vacío")
+    return core.Frame(await files[0].read(), get_printer_id(request))
+
+async def read_base64_frame(request):
+    """Imagen base64 en JSON, decodificada en streaming conforme llega el cuerpo"""
+    if request.headers.get('content-type', '').split(';')[0].strip() != 'application/json':
+        raise core.InputError("No se envió imagen en base64")
+
+    length = check_content_length(request)
+    decoder = core.Base64StreamDecoder(length)
+    received = 0
+    checked = False
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > core.MAX_UPLOAD_BYTES:
+            raise too_large()
+        if decoder.done or not chunk:
+            # El resto del JSON se descarta
+            continue
+        decoder.feed(chunk)
+        if not checked and (decoder.decoded_size >= core.HEADER_PROBE_BYTES or decoder.done):
+            core.check_image_header(decoder.result())
+            checked = True
+
+    if not decoder.done:
+        raise core.InputError("No se envió imagen en base64")
+    return core.Frame(decoder.result(), get_printer_id(request))
+
+async def handle_detection(request, process, description):
+    """Manejo de errores común a las rutas de detección (igual que en app.py)"""
+    try:
+        if core.pipeline is None:
+            return JSONResponse({"error": "Modelo no disponible"}, status_code=500)
+
+        # Rechazo rápido, antes de leer el cuerpo, si la cola ya está llena
+        core.batcher.check_capacity()
+        return JSONResponse(await process(request))
+
+    except core.Overloaded as e:
+        body, headers = core.overloaded_response(e)
+        return JSONResponse(body, status_code=503, headers=headers)
+    except core.InputError as e:
+        return JSONResponse({"error": e.message}, status_code=e.status)
+    except Exception as e:
+        logger.error(f"Error en {description}: {str(e)}")
+        return JSONResponse({"error": f"Error interno del servidor: {str(e)}"}, status_code=500)
+
+async def health_check(request):
+    """Endpoint de verificación de salud"""
+    return JSONResponse(core.health_status())
+
+async def prometheus_metrics(request):
+    """Métricas en formato de exposición de Prometheus"""
+    body, content_type = metrics.render_metrics()
+    return Response(body, media_type=content_type)
+
+async def alert_status(request):
+    """Consulta el estado de una alerta encolada"""
+    status = core.alert_dispatcher.status(request.path_params['alert_id'])
+    if status is None:
+        return JSONResponse({"error": "Alerta no encontrada"}, status_code=404)
+    return JSONResponse(status)
+
+async def detect_errors(request):
+    """Endpoint principal para detección de errores (multipart o imagen binaria)"""
+    async def process(request):
+        content_type = request.headers.get('content-type', '').split(';')[0].strip()
+        with metrics.timed("body_read"):
+            if content_type in core.RAW_IMAGE_TYPES:
+                frame = await read_raw_frame(request)
+            else:
+                frame = await read_multipart_frame(request)
+        return await run_inference(core.pipeline.run, frame)
+    return await handle_detection(request, process, "detección")
+
+async def detect_errors_batch(request):
+    """Endpoint que acepta varias imágenes (partes 'image') en una sola petición"""
+    async def process(request):
+        with metrics.timed("body_read"):
+            files = await read_multipart_files(request)
+            if not files:
+                raise core.InputError("No se envió ninguna imagen")
+            printer_id = get_printer_id(request)
+            frames = [core.Frame(await file.read(), core.get_part_printer_id(file, printer_id),
+                                 name=file.filename)
+                      for file in files]
+        return core.batch_response(frames, await run_inference(core.pipeline.run_many, frames))
+    return await handle_detection(request, process, "detección por lotes")
+
+async def detect_errors_base64(request):
+    """Endpoint alternativo que acepta imágenes en base64"""
+    async def process(request):
+        with metrics.timed("body_read"):
+            frame = await read_base64_frame(request)
+        return await run_inference(core.pipeline.run, frame)
+    return await handle_detection(request, process, "detección base64")
+
+app = Starlette(routes=[
+    Route('/', health_check, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+    Route('/alerts/{alert_id}', alert_status, methods=['GET']),
+    Route('/detect', detect_errors, methods=['POST']),
+    Route('/detect_batch', detect_errors_batch, methods=['POST']),
+    Route('/detect_base64', detect_errors_base64, methods=['POST']),
+])
@@ -0,0 +1,312 @@
+"""Benchmark del servidor de detección.
+
+Modos:
+    load    Reproduce un directorio de fotogramas contra un servidor ya en marcha:
+            de uno en uno (single), con varios clientes (concurrent) o varias
+            imágenes por petición a /detect_batch (batch). Informa de
+            rendimiento, latencia p50/p95/p99 y tiempo medio por etapa (leído
+            de /metrics antes y después de la medición).
+    micro   Ejecuta el pipeline dentro del proceso, sin HTTP, para detectar
+            regresiones en decodificación, inferencia o serialización.
+    sweep   Lanza gunicorn con cada combinación de workers / hilos de PyTorch /
+            hilos de OpenCV y mide peticiones por segundo y latencia p95 de /detect.
+
+Cada petición usa un X-Printer-ID distinto y micro/sweep desactivan la caché
+de resultados (RESULT_CACHE_SIZE=0): con fotogramas repetidos se mediría la
+caché en lugar de la inferencia.
+
+Uso:
+    python benchmark.py load --url http://127.0.0.1:5000 --mode concurrent --concurrency 8
+    python benchmark.py load --mode batch --batch-size 4
+    python benchmark.py micro --frames captures/ --requests 100
+    python benchmark.py sweep --frames captures/ --workers 1 2 4 --torch-threads 1 2 4
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+# Identificadores de impresora únicos en todo el benchmark (calentamiento incluido)
+_printer_ids = itertools.count()
+
+def load_frames(directory, limit=None):
+    """Bytes de las imágenes de un directorio; si no hay, un fotograma sintético 1280x720"""
+    paths = sorted(p for pattern in IMAGE_PATTERNS for p in glob.glob(os.path.join(directory or '', pattern)))
+    frames = []
+    for path in paths[:limit] if limit else paths:
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+
+    if not frames:
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+        frames.append(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes())
+    return frames
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else float('nan')
+
+def summarize(latencies, errors, elapsed, batch_size=1):
+    """Resumen de una ejecución: rendimiento y percentiles de latencia en ms"""
+    latencies_ms = [1000 * latency for latency in latencies]
+    rps = len(latencies) / elapsed if elapsed > 0 else 0.0
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": rps,
+        "images_per_s": rps * batch_size,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+    }
+
+def post_frames(session, base_url, images, upload='multipart', printer_id='benchmark'):
+    """Envía uno o varios fotogramas; varios van juntos a /detect_batch"""
+    headers = {'X-Printer-ID': printer_id}
+    if len(images) > 1:
+        files = [('image', (f'frame{i}.jpg', image, 'image/jpeg')) for i, image in enumerate(images)]
+        return session.post(f"{base_url}/detect_batch", files=files, headers=headers, timeout=120)
+    if upload == 'raw':
+        headers['Content-Type'] = 'image/jpeg'
+        return session.post(f"{base_url}/detect", data=images[0], headers=headers, timeout=120)
+    files = {'image': ('frame.jpg', images[0], 'image/jpeg')}
+    return session.post(f"{base_url}/detect", files=files, headers=headers, timeout=120)
+
+def run_load(base_url, frames, total, concurrency, batch_size=1, upload='multipart'):
+    """Envía `total` peticiones de `batch_size` fotogramas con `concurrency` clientes simultáneos"""
+    local = threading.local()
+
+    def send(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        images = [frames[(i * batch_size + j) % len(frames)] for j in range(batch_size)]
+        start = time.perf_counter()
+        try:
+            # Una impresora distinta por petición para no medir aciertos de la caché de resultados
+            printer_id = f"benchmark-{next(_printer_ids)}"
+            ok = post_frames(local.session, base_url, images, upload, printer_id).status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for ok, latency in outcomes if ok]
+    return summarize(latencies, len(outcomes) - len(latencies), elapsed, batch_size)
+
+def stage_totals(exposition):
+    """Suma y número de observaciones por etapa del histograma de metrics.py"""
+    from prometheus_client.parser import text_string_to_metric_families
+
+    totals = {}
+    for family in text_string_to_metric_families(exposition):
+        if family.name != "deteccion_stage_seconds":
+            continue
+        for sample in family.samples:
+            stage = sample.labels.get("stage")
+            if sample.name.endswith("_sum"):
+                totals.setdefault(stage, [0.0, 0])[0] += sample.value
+            elif sample.name.endswith("_count"):
+                totals.setdefault(stage, [0.0, 0])[1] += int(sample.value)
+    return totals
+
+def stage_means(before, after):
+    """Tiempo medio (ms) y número de observaciones de cada etapa entre dos lecturas"""
+    means = {}
+    for stage, (total, count) in after.items():
+        previous_total, previous_count = before.get(stage, (0.0, 0))
+        if count > previous_count:
+            means[stage] = {
+                "mean_ms": 1000 * (total - previous_total) / (count - previous_count),
+                "count": count - previous_count,
+            }
+    return means
+
+def scrape_stages(base_url):
+    """Lee /metrics del servidor; vacío si no expone métricas"""
+    try:
+        response = requests.get(f"{base_url}/metrics", timeout=10)
+    except requests.exceptions.RequestException:
+        return {}
+    return stage_totals(response.text) if response.status_code == 200 else {}
+
+def print_report(report, stages):
+    print(f"peticiones: {report['requests']} (errores: {report['errors']})")
+    print(f"rendimiento: {report['rps']:.2f} req/s, {report['images_per_s']:.2f} imágenes/s")
+    print(f"latencia: p50 {report['p50_ms']:.1f} ms, p95 {report['p95_ms']:.1f} ms, p99 {report['p99_ms']:.1f} ms")
+    if stages:
+        print(f"{'etapa':>14} {'media ms':>9} {'n':>7}")
+        for stage, values in stages.items():
+            print(f"{stage:>14} {values['mean_ms']:>9.2f} {values['count']:>7}")
+
+def write_report(path, report):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+def load(args):
+    """Mide un servidor ya en marcha en modo single, concurrent o batch"""
+    frames = load_frames(args.frames, args.limit)
+    base_url = args.url.rstrip('/')
+    concurrency = 1 if args.mode == 'single' else args.concurrency
+    batch_size = args.batch_size if args.mode == 'batch' else 1
+
+    run_load(base_url, frames, args.warmup, concurrency, batch_size, args.upload)
+    before = scrape_stages(base_url)
+    report = run_load(base_url, frames, args.requests, concurrency, batch_size, args.upload)
+    report["stages"] = stage_means(before, scrape_stages(base_url))
+    report.update(mode=args.mode, concurrency=concurrency, batch_size=batch_size, upload=args.upload)
+
+    print_report(report, report["stages"])
+    write_report(args.output, report)
+
+def micro(args):
+    """Pipeline dentro del proceso (decode -> inferencia -> postproceso -> JSON), sin HTTP"""
+    # Las alertas de Telegram no deben salir durante el benchmark
+    os.environ.setdefault("TELEGRAM_API_URL", "http://127.0.0.1:9")
+    # Medir la inferencia, no la caché de resultados
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+    import app
+    import metrics
+
+    if app.pipeline is None:
+        raise SystemExit("No se pudo cargar el modelo")
+
+    frames = load_frames(args.frames, args.limit)
+
+    def run_once(i):
+        images = [frames[(i * args.batch_size + j) % len(frames)] for j in range(args.batch_size)]
+        batch = [app.Frame(image, f"benchmark-{next(_printer_ids)}") for image in images]
+        start = time.perf_counter()
+        responses = app.pipeline.run_many(batch) if len(batch) > 1 else [app.pipeline.run(batch[0])]
+        with metrics.timed("serialize"):
+            json.dumps(responses)
+        return time.perf_counter() - start
+
+    for i in range(args.warmup):
+        run_once(i)
+
+    before = stage_totals(metrics.render_metrics()[0].decode())
+    start = time.perf_counter()
+    latencies = [run_once(i) for i in range(args.requests)]
+    report = summarize(latencies, 0, time.perf_counter() - start, args.batch_size)
+    report["stages"] = stage_means(before, stage_totals(metrics.render_metrics()[0].decode()))
+    report.update(mode="micro", batch_size=args.batch_size, backend=app.INFERENCE_BACKEND)
+
+    print_report(report, report["stages"])
+    write_report(args.output, report)
+
+def start_server(port, env_overrides, startup_timeout=300):
+    """Arranca gunicorn con la configuración del repo y espera a que cargue el modelo"""
+    env = dict(os.environ, PORT=str(port), **env_overrides)
+    # Las alertas de Telegram no deben salir durante el benchmark
+    env.setdefault("TELEGRAM_API_URL", "http://127.0.0.1:9")
+    env.setdefault("RESULT_CACHE_SIZE", "0")
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn terminó al arrancar (código {process.returncode})")
+        try:
+            if requests.get(f"{base_url}/", timeout=2).json().get("model_loaded"):
+                return process, base_url
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        time.sleep(1)
+
+    stop_server(process)
+    raise RuntimeError("El servidor no estuvo listo a tiempo")
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def sweep(args):
+    """Mide /detect con cada combinación de workers e hilos"""
+    frames = load_frames(args.frames, args.limit)
+    combinations = itertools.product(args.workers, args.torch_threads, args.opencv_threads)
+
+    print(f"{'workers':>7} {'torch':>5} {'opencv':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errores':>7}")
+    for workers, torch_threads, opencv_threads in combinations:
+        process, base_url = start_server(args.port, {
+            "WEB_CONCURRENCY": str(workers),
+            "TORCH_NUM_THREADS": str(torch_threads),
+            "OPENCV_NUM_THREADS": str(opencv_threads),
+        })
+        try:
+            run_load(base_url, frames, args.warmup, args.concurrency)
+            report = run_load(base_url, frames, args.requests, args.concurrency)
+        finally:
+            stop_server(process)
+
+        print(f"{workers:>7} {torch_threads:>5} {opencv_threads:>6} {report['rps']:>8.2f} "
+              f"{report['p50_ms']:>8.1f} {report['p95_ms']:>8.1f} {report['errors']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    load_parser = subparsers.add_parser('load', help="Carga contra un servidor ya en marcha")
+    load_parser.add_argument('--url', default='http://127.0.0.1:5000', help="URL base del servidor")
+    load_parser.add_argument('--mode', choices=['single', 'concurrent', 'batch'], default='single')
+    load_parser.add_argument('--frames', default='captures', help="Directorio de fotogramas JPEG")
+    load_parser.add_argument('--limit', type=int, default=50, help="Máximo de fotogramas a cargar")
+    load_parser.add_argument('--concurrency', type=int, default=8, help="Clientes simultáneos (concurrent/batch)")
+    load_parser.add_argument('--batch-size', type=int, default=4, help="Imágenes por petición en modo batch")
+    load_parser.add_argument('--upload', choices=['multipart', 'raw'], default='multipart',
+                             help="Formato de subida a /detect")
+    load_parser.add_argument('--requests', type=int, default=200, help="Peticiones medidas")
+    load_parser.add_argument('--warmup', type=int, default=10, help="Peticiones de calentamiento")
+    load_parser.add_argument('--output', help="Guardar el informe en JSON")
+    load_parser.set_defaults(func=load)
+
+    micro_parser = subparsers.add_parser('micro', help="Pipeline en proceso, sin HTTP")
+    micro_parser.add_argument('--frames', default='captures', help="Directorio de fotogramas JPEG")
+    micro_parser.add_argument('--limit', type=int, default=50, help="Máximo de fotogramas a cargar")
+    micro_parser.add_argument('--batch-size', type=int, default=1, help="Fotogramas por llamada al pipeline")
+    micro_parser.add_argument('--requests', type=int, default=100, help="Llamadas medidas")
+    micro_parser.add_argument('--warmup', type=int, default=5, help="Llamadas de calentamiento")
+    micro_parser.add_argument('--output', help="Guardar el informe en JSON")
+    micro_parser.set_defaults(func=micro)
+
+    sweep_parser = subparsers.add_parser('sweep', help="Barrido de workers e hilos con gunicorn")
+    sweep_parser.add_argument('--frames', default='captures', help="Directorio de fotogramas JPEG")
+    sweep_parser.add_argument('--limit', type=int, default=50, help="Máximo de fotogramas a cargar")
+    sweep_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    sweep_parser.add_argument('--torch-threads', type=int, nargs='+', default=[1, 2, 4])
+    sweep_parser.add_argument('--opencv-threads', type=int, nargs='+', default=[1])
+    sweep_parser.add_argument('--concurrency', type=int, default=8, help="Clientes simultáneos")
+    sweep_parser.add_argument('--requests', type=int, default=200, help="Peticiones medidas por combinación")
+    sweep_parser.add_argument('--warmup', type=int, default=10, help="Peticiones de calentamiento")
+    sweep_parser.add_argument('--port', type=int, default=5055)
+    sweep_parser.set_defaults(func=sweep)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
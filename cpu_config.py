@@ -0,0 +1,64 @@
+"""Reparto de núcleos de CPU entre workers de gunicorn, PyTorch y OpenCV.
+
+Por defecto PyTorch usa un hilo por núcleo en cada proceso, así que con
+varios workers los hilos se pisan y la latencia se dispara bajo carga. Aquí
+se calcula cuántos workers lanzar y cuántos hilos de inferencia dar a cada
+uno. Este módulo no importa torch al cargarse para que gunicorn.conf.py
+pueda usarlo sin cargar el modelo.
+"""
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))  # 0 = núcleos / workers
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "1"))
+OPENCV_NUM_THREADS = int(os.getenv("OPENCV_NUM_THREADS", "1"))
+
+def available_cpus():
+    """Núcleos realmente disponibles (afinidad del proceso y cuota de cgroup)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # En contenedores (Render) la cuota de cgroup v2 puede ser menor que los núcleos visibles
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+def default_worker_count(cpus=None):
+    """Workers por defecto: uno por cada dos núcleos (al menos uno)"""
+    return max(1, (cpus or available_cpus()) // 2)
+
+def worker_count():
+    """Workers configurados (WEB_CONCURRENCY) o derivados de los núcleos"""
+    return int(os.getenv("WEB_CONCURRENCY", "0")) or default_worker_count()
+
+def configure_threads(workers=None):
+    """Fija los hilos de PyTorch y OpenCV de este proceso.
+
+    Los núcleos se reparten entre los workers salvo que TORCH_NUM_THREADS
+    indique un valor explícito. Devuelve el número de hilos de PyTorch.
+    """
+    import cv2
+    import torch
+
+    workers = workers or worker_count()
+    num_threads = TORCH_NUM_THREADS or max(1, available_cpus() // workers)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+    except RuntimeError:
+        # Solo se puede fijar una vez por proceso, antes de cualquier trabajo paralelo
+        pass
+    cv2.setNumThreads(OPENCV_NUM_THREADS)
+
+    logger.info(f"Hilos configurados: torch={num_threads}, interop={torch.get_num_interop_threads()}, "
+                f"opencv={OPENCV_NUM_THREADS}, workers={workers}")
+    return num_threads
@@ -0,0 +1,174 @@
+"""Exporta modelo/impresion.pt a ONNX / OpenVINO y comprueba la paridad con PyTorch.
+
+Usa el export.py de la copia local de YOLOv5 (vendor/yolov5), que guarda los
+nombres de clase y el stride en los metadatos del modelo exportado, de modo
+que app.py puede servirlo con INFERENCE_BACKEND=onnx u openvino sin cambiar
+el pre/postprocesado.
+
+Uso:
+    python export_model.py                              # exporta a ONNX
+    python export_model.py --include onnx openvino      # OpenVINO requiere openvino-dev
+    python export_model.py --check-only --frames captures/
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import app
+
+logger = logging.getLogger("export_model")
+
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+def export(include, imgsz, dynamic=True):
+    """Exporta los pesos de MODEL_PATH a los formatos indicados"""
+    source, kind = app.resolve_yolov5_source()
+    if kind != 'local':
+        raise SystemExit("Se necesita una copia local de YOLOv5 (vendor/yolov5) para exportar")
+
+    sys.path.insert(0, os.path.abspath(source))
+    import export as yolov5_export
+
+    # Ejes dinámicos para que el micro-batcher pueda enviar lotes de N imágenes
+    with app.trusted_checkpoint_load():
+        return yolov5_export.run(
+            weights=app.MODEL_PATH,
+            include=include,
+            imgsz=(imgsz, imgsz),
+            device='cpu',
+            dynamic=dynamic,
+            simplify=True,
+        )
+
+def load_frames(directory, limit=None):
+    """Rutas de las imágenes de un directorio (por ejemplo captures/)"""
+    paths = sorted(p for pattern in IMAGE_PATTERNS for p in glob.glob(os.path.join(directory, pattern)))
+    return paths[:limit] if limit else paths
+
+def box_iou(a, b):
+    """Matriz IoU (N, M) entre dos arrays de cajas x1, y1, x2, y2"""
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+def match_detections(reference, candidate, iou_thres=0.5):
+    """Empareja detecciones de la misma clase por IoU (voraz, por confianza).
+
+    Devuelve una lista de pares (índice en reference, índice en candidate).
+    """
+    if len(reference) == 0 or len(candidate) == 0:
+        return []
+
+    iou = box_iou(reference.boxes[:, :4], candidate.boxes[:, :4])
+    iou[reference.boxes[:, 5][:, None] != candidate.boxes[:, 5][None, :]] = 0
+
+    matches = []
+    used = set()
+    for i in np.argsort(-reference.boxes[:, 4]):
+        for j in np.argsort(-iou[i]):
+            if iou[i, j] < iou_thres:
+                break
+            if j not in used:
+                used.add(j)
+                matches.append((int(i), int(j)))
+                break
+    return matches
+
+def compare_models(reference_model, candidate_model, frames, iou_thres=0.5):
+    """Compara las detecciones de dos modelos sobre los mismos fotogramas"""
+    reference_total = candidate_total = matched = compared = 0
+    confidence_diffs = []
+
+    for path in frames:
+        image = cv2.imread(path)
+        if image is None:
+            logger.warning(f"No se pudo leer {path}")
+            continue
+        compared += 1
+
+        reference = app.DetectionResult.from_results(reference_model(image))
+        candidate = app.DetectionResult.from_results(candidate_model(image))
+        matches = match_detections(reference, candidate, iou_thres)
+
+        reference_total += len(reference)
+        candidate_total += len(candidate)
+        matched += len(matches)
+        confidence_diffs.extend(abs(reference.boxes[i, 4] - candidate.boxes[j, 4]) for i, j in matches)
+
+    precision = matched / candidate_total if candidate_total else 1.0
+    recall = matched / reference_total if reference_total else 1.0
+    agreement = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "frames": compared,
+        "reference_detections": reference_total,
+        "candidate_detections": candidate_total,
+        "matched": matched,
+        "precision": precision,
+        "recall": recall,
+        "agreement": agreement,
+        "max_confidence_diff": float(max(confidence_diffs, default=0.0)),
+        "mean_confidence_diff": float(np.mean(confidence_diffs)) if confidence_diffs else 0.0,
+    }
+
+def check_parity(backends, frames, iou_thres, min_agreement):
+    """Compara cada backend exportado con PyTorch; devuelve False si alguno no cumple"""
+    reference_model = app.load_model(app.resolve_model_path('torch'))
+    if reference_model is None:
+        raise SystemExit("No se pudo cargar el modelo PyTorch de referencia")
+
+    ok = True
+    for backend in backends:
+        candidate_model = app.load_model(app.resolve_model_path(backend))
+        if candidate_model is None:
+            logger.error(f"No se pudo cargar el modelo {backend}")
+            ok = False
+            continue
+
+        report = compare_models(reference_model, candidate_model, frames, iou_thres)
+        logger.info(f"Paridad torch vs {backend}: {report}")
+        if report["frames"] == 0:
+            logger.error(f"{backend}: no se pudo leer ningún fotograma")
+            ok = False
+        elif report["agreement"] < min_agreement:
+            logger.error(f"{backend}: concordancia {report['agreement']:.3f} < {min_agreement}")
+            ok = False
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--include', nargs='+', default=['onnx'], choices=['onnx', 'openvino'])
+    parser.add_argument('--imgsz', type=int, default=640, help="Tamaño de entrada de la red")
+    parser.add_argument('--static', action='store_true', help="Exportar con tamaño de lote fijo (1)")
+    parser.add_argument('--frames', default='captures', help="Directorio de fotogramas para la paridad")
+    parser.add_argument('--limit', type=int, default=200, help="Máximo de fotogramas a comparar")
+    parser.add_argument('--iou', type=float, default=0.5, help="IoU mínimo para emparejar detecciones")
+    parser.add_argument('--min-agreement', type=float, default=0.95)
+    parser.add_argument('--check-only', action='store_true', help="No exportar, solo comprobar paridad")
+    args = parser.parse_args()
+
+    if not args.check_only:
+        exported = export(args.include, args.imgsz, dynamic=not args.static)
+        logger.info(f"Modelos exportados: {[f for f in exported if f]}")
+
+    frames = load_frames(args.frames, args.limit)
+    if not frames:
+        if args.check_only:
+            # Sin fotogramas no hay nada que comprobar: no dar la paridad por buena
+            raise SystemExit(f"No hay fotogramas en {args.frames} para comprobar la paridad")
+        logger.warning(f"No hay fotogramas en {args.frames}: se omite la comprobación de paridad")
+        return
+
+    if not check_parity(args.include, frames, args.iou, args.min_agreement):
+        sys.exit(1)
+    logger.info("Paridad correcta")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Configuración de gunicorn para el servidor de detección
+#
+# Con preload_app el modelo se carga una sola vez en el proceso maestro y los
+# workers lo heredan por fork (copy-on-write), así que añadir workers apenas
+# aumenta la memoria y cada worker nuevo está listo al instante.
+import gc
+import os
+import shutil
+
+from cpu_config import configure_threads, worker_count
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = worker_count()
+# app.py reparte los hilos de PyTorch según este mismo número de workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+worker_class = "gthread"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# Métricas de Prometheus compartidas entre workers: el directorio tiene que
+# existir (y estar vacío) antes de que app.py importe prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+def when_ready(server):
+    """Prepara el modelo precargado antes de que se creen los workers"""
+    if not preload_app:
+        return
+
+    # El módulo ya está importado por preload_app; no se ejecuta inferencia
+    # aquí para no arrancar hilos de OpenMP antes del fork
+    import app as application
+    application.prepare_model_for_fork(application.model)
+
+    # Congelar los objetos actuales evita que el recolector de basura toque
+    # sus cabeceras en los workers y provoque copias de páginas
+    gc.freeze()
+    server.log.info("Modelo precargado y compartido con los workers")
+
+def post_fork(server, worker):
+    configure_threads(workers)
+    server.log.info(f"Worker {worker.pid} listo (modelo heredado del maestro)")
+
+def child_exit(server, worker):
+    """Descarta los gauges del worker que termina en las métricas agregadas"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,66 @@
+"""Métricas Prometheus del servidor de detección.
+
+Histogramas de duración por etapa (lectura del cuerpo, cv2.imdecode,
+inferencia, postprocesado, render, codificación JPEG y envío a Telegram),
+contadores de detecciones por clase, de resultados de alertas y de aciertos
+de la caché de resultados, y gauges de profundidad de colas y tiempo de
+carga del modelo.
+
+Con varios workers de gunicorn se usa el modo multiproceso de
+prometheus_client: gunicorn.conf.py define PROMETHEUS_MULTIPROC_DIR antes
+de cargar la aplicación y /metrics agrega los valores de todos los workers.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+
+# Etapas medidas (valores de la etiqueta "stage")
+STAGES = ("body_read", "decode", "inference", "postprocess", "render", "jpeg_encode", "telegram_post")
+
+STAGE_SECONDS = Histogram(
+    "deteccion_stage_seconds", "Duración de cada etapa del procesamiento de un fotograma",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+BATCH_SIZE = Histogram(
+    "deteccion_inference_batch_size", "Imágenes por pasada del modelo",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+DETECTIONS = Counter("deteccion_detections_total", "Detecciones por clase", ["class_name"])
+ALERTS = Counter("deteccion_alerts_total", "Resultado de las alertas", ["outcome"])
+RESULT_CACHE = Counter("deteccion_result_cache_total", "Consultas a la caché de resultados", ["outcome"])
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "deteccion_inference_queue_depth", "Fotogramas esperando inferencia", multiprocess_mode="livesum",
+)
+ALERT_QUEUE_DEPTH = Gauge(
+    "deteccion_alert_queue_depth", "Alertas pendientes de envío", multiprocess_mode="livesum",
+)
+MODEL_LOAD_SECONDS = Gauge(
+    "deteccion_model_load_seconds", "Tiempo de carga del modelo", multiprocess_mode="max",
+)
+
+@contextmanager
+def timed(stage):
+    """Mide la duración del bloque y la registra en el histograma de la etapa"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+def count_detections(labels):
+    """Suma las detecciones de un fotograma por clase"""
+    for name in set(labels):
+        DETECTIONS.labels(name).inc(labels.count(name))
+
+def render_metrics():
+    """Texto de exposición de Prometheus y su Content-Type"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
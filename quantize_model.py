@@ -0,0 +1,206 @@
+"""Cuantiza el modelo ONNX a INT8 y compara su precisión con el modelo FP32.
+
+Parte del ONNX generado por export_model.py. La cuantización estática se
+calibra con fotogramas reales (por ejemplo los que guarda raspberry_client.py
+en captures/); la dinámica solo cuantiza los pesos y no necesita calibración.
+El modelo resultante se sirve con INFERENCE_BACKEND=onnx-int8.
+
+El informe compara FP32 e INT8 sobre fotogramas no usados en la calibración:
+concordancia de detecciones, mAP@0.5 tomando FP32 como referencia y latencia
+media, para decidir por despliegue si compensa servir INT8.
+
+Uso:
+    python export_model.py
+    python quantize_model.py --frames captures/ --mode static
+    python quantize_model.py --report-only
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+import app
+from export_model import box_iou, load_frames, match_detections
+
+logger = logging.getLogger("quantize_model")
+
+def letterbox(image, size, color=114):
+    """Redimensiona manteniendo proporción y rellena hasta size x size (como AutoShape)"""
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+    resized = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top = (size - new_h) // 2
+    left = (size - new_w) // 2
+    return cv2.copyMakeBorder(resized, top, size - new_h - top, left, size - new_w - left,
+                              cv2.BORDER_CONSTANT, value=(color, color, color))
+
+class FrameCalibrationReader:
+    """Lector de datos de calibración para onnxruntime.quantization"""
+
+    def __init__(self, frames, input_name, imgsz):
+        self.frames = iter(frames)
+        self.input_name = input_name
+        self.imgsz = imgsz
+
+    def get_next(self):
+        for path in self.frames:
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            # Mismo preprocesado que AutoShape: letterbox, HWC -> NCHW y escala a [0, 1]
+            x = letterbox(image, self.imgsz).transpose(2, 0, 1)[None]
+            return {self.input_name: np.ascontiguousarray(x, dtype=np.float32) / 255.0}
+        return None
+
+def quantize(fp32_path, int8_path, mode, calibration_frames, imgsz):
+    """Genera el modelo INT8 y conserva los metadatos (nombres de clase, stride)"""
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if mode == 'static':
+        session = onnxruntime.InferenceSession(fp32_path, providers=['CPUExecutionProvider'])
+        reader = FrameCalibrationReader(calibration_frames, session.get_inputs()[0].name, imgsz)
+        quantize_static(fp32_path, int8_path, reader, quant_format=QuantFormat.QDQ,
+                        per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    else:
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QUInt8)
+
+    # La cuantización descarta metadata_props; sin ellos se pierden los nombres de clase
+    fp32_model = onnx.load(fp32_path, load_external_data=False)
+    int8_model = onnx.load(int8_path)
+    existing = {prop.key for prop in int8_model.metadata_props}
+    for prop in fp32_model.metadata_props:
+        if prop.key not in existing:
+            int8_model.metadata_props.add(key=prop.key, value=prop.value)
+    onnx.save(int8_model, int8_path)
+
+def mean_average_precision(references, candidates, iou_thres=0.5):
+    """mAP@iou de los candidatos tomando las detecciones de referencia como verdad"""
+    scores = defaultdict(list)
+    ground_truth = defaultdict(int)
+
+    for reference, candidate in zip(references, candidates):
+        for cls in np.unique(np.concatenate([reference.boxes[:, 5], candidate.boxes[:, 5]])):
+            truth = reference.boxes[reference.boxes[:, 5] == cls]
+            predicted = candidate.boxes[candidate.boxes[:, 5] == cls]
+            ground_truth[cls] += len(truth)
+
+            predicted = predicted[np.argsort(-predicted[:, 4])]
+            iou = box_iou(predicted[:, :4], truth[:, :4]) if len(truth) else np.zeros((len(predicted), 0))
+            used = np.zeros(len(truth), dtype=bool)
+            for row, confidence in enumerate(predicted[:, 4]):
+                candidates_iou = np.where(used, 0, iou[row]) if len(truth) else iou[row]
+                best = int(np.argmax(candidates_iou)) if len(truth) else -1
+                is_match = best >= 0 and candidates_iou[best] >= iou_thres
+                if is_match:
+                    used[best] = True
+                scores[cls].append((confidence, is_match))
+
+    average_precisions = []
+    for cls, total in ground_truth.items():
+        if total == 0:
+            continue
+        records = sorted(scores[cls], key=lambda r: -r[0])
+        hits = np.array([hit for _, hit in records], dtype=float)
+        if hits.size == 0:
+            average_precisions.append(0.0)
+            continue
+        tp = np.cumsum(hits)
+        recall = tp / total
+        precision = tp / np.arange(1, len(hits) + 1)
+        # Área bajo la envolvente de precisión (interpolación de todos los puntos)
+        recall = np.concatenate([[0.0], recall, [1.0]])
+        precision = np.concatenate([[1.0], precision, [0.0]])
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        average_precisions.append(float(np.sum(np.diff(recall) * precision[1:])))
+
+    return float(np.mean(average_precisions)) if average_precisions else 1.0
+
+def run_model(model, frames):
+    """Detecciones y latencia media (ms) de un modelo sobre los fotogramas"""
+    detections = []
+    elapsed = 0.0
+    for path in frames:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        start = time.perf_counter()
+        results = model(image)
+        elapsed += time.perf_counter() - start
+        detections.append(app.DetectionResult.from_results(results))
+    return detections, 1000 * elapsed / max(len(detections), 1)
+
+def accuracy_report(fp32_path, int8_path, frames, iou_thres=0.5):
+    """Compara FP32 e INT8 sobre los mismos fotogramas"""
+    fp32_model = app.load_model(fp32_path)
+    int8_model = app.load_model(int8_path)
+    if fp32_model is None or int8_model is None:
+        raise SystemExit("No se pudieron cargar los modelos FP32/INT8")
+
+    references, fp32_ms = run_model(fp32_model, frames)
+    candidates, int8_ms = run_model(int8_model, frames)
+
+    matched = sum(len(match_detections(r, c, iou_thres)) for r, c in zip(references, candidates))
+    reference_total = sum(len(r) for r in references)
+    candidate_total = sum(len(c) for c in candidates)
+    precision = matched / candidate_total if candidate_total else 1.0
+    recall = matched / reference_total if reference_total else 1.0
+
+    return {
+        "frames": len(references),
+        "fp32_detections": reference_total,
+        "int8_detections": candidate_total,
+        "agreement": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "precision": precision,
+        "recall": recall,
+        "map50_vs_fp32": mean_average_precision(references, candidates, iou_thres),
+        "fp32_latency_ms": fp32_ms,
+        "int8_latency_ms": int8_ms,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', default='captures', help="Directorio de fotogramas capturados")
+    parser.add_argument('--mode', choices=['static', 'dynamic'], default='static')
+    parser.add_argument('--imgsz', type=int, default=640, help="Tamaño de entrada usado al exportar")
+    parser.add_argument('--calibration-size', type=int, default=100, help="Fotogramas para calibrar")
+    parser.add_argument('--eval-size', type=int, default=200, help="Fotogramas para el informe")
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--report', default='quantization_report.json', help="Fichero del informe")
+    parser.add_argument('--report-only', action='store_true', help="No cuantizar, solo comparar")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fp32_path = app.resolve_model_path('onnx')
+    int8_path = app.resolve_model_path('onnx-int8')
+
+    frames = load_frames(args.frames)
+    if not frames:
+        raise SystemExit(f"No hay fotogramas en {args.frames}")
+
+    # Calibración y evaluación con fotogramas distintos
+    random.Random(args.seed).shuffle(frames)
+    calibration = frames[:args.calibration_size]
+    evaluation = frames[args.calibration_size:][:args.eval_size] or calibration
+
+    if not args.report_only:
+        logger.info(f"Cuantizando {fp32_path} ({args.mode}, {len(calibration)} fotogramas de calibración)")
+        quantize(fp32_path, int8_path, args.mode, calibration, args.imgsz)
+        logger.info(f"Modelo INT8 guardado en {int8_path}")
+
+    report = accuracy_report(fp32_path, int8_path, evaluation, args.iou)
+    report["mode"] = args.mode
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Informe de precisión FP32 vs INT8: {report}")
+
+if __name__ == '__main__':
+    sys.exit(main())
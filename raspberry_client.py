@@ -1,14 +1,26 @@
 import base64
 import logging
+import queue
+import threading
+import time
 from datetime import datetime
 import os
+import cv2
+import requests
 from picamera2 import Picamera2  # Para Raspberry Pi Camera
 import numpy as np
 
 # Configuración
 SERVER_URL = "https://tu-app-render.onrender.com"  # Cambiar por tu URL de Render
-CAPTURE_INTERVAL = 30  # Intervalo en segundos entre capturas
+CAPTURE_INTERVAL = 30  # Intervalo en segundos entre capturas (si el servidor no sugiere otro)
+MIN_CAPTURE_INTERVAL = 2  # Límites para el intervalo sugerido por el servidor (next_interval)
+MAX_CAPTURE_INTERVAL = 600
 USE_PI_CAMERA = True  # True para cámara de RPi, False para webcam USB
+PRINTER_ID = "impresora-1"  # Identificador de esta impresora en el servidor
+UPLOAD_MODE = "raw"  # "raw" envía el JPEG como cuerpo binario, "multipart" como formulario
+CHANGE_THRESHOLD = 4.0  # Diferencia media (0-255) con el último envío para considerar que hubo cambios
+CHANGE_DETECTION_SIZE = (160, 90)  # Resolución de la miniatura en gris usada para comparar
+MAX_SKIP_INTERVAL = 300  # Segundos máximos sin enviar un fotograma aunque no haya cambios
 
 # Configurar logging
 logging.basicConfig(
@@ -26,6 +38,15 @@ class CameraClient:
         self.camera = None
         self.session = requests.Session()
         self.session.timeout = 30
+        self.session.headers['X-Printer-ID'] = PRINTER_ID
+        self.retry_after = None  # Segundos pedidos por el servidor cuando está saturado
+        self.overload_hint = None  # Retry-After del envío en curso, aún sin publicar
+        self.capture_interval = CAPTURE_INTERVAL  # Intervalo actual, adaptado según el servidor
+        self.last_uploaded = None  # Miniatura del último fotograma enviado
+        self.last_upload_time = 0.0
+        self.last_status = None  # Último estado devuelto por el servidor
+        # Avisa al hilo de captura de que cambió el intervalo o el Retry-After
+        self.schedule_changed = threading.Event()
         
     def initialize_camera(self):
         """Inicializar la cámara según la configuración"""
@@ -76,18 +97,55 @@ class CameraClient:
             logger.error(f"Error al capturar imagen: {e}")
             return None
     
-    def send_image_to_server(self, image):
-        """Enviar imagen al servidor para detección"""
+    def frame_signature(self, image):
+        """Miniatura en gris del fotograma para compararlo con el último enviado"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, CHANGE_DETECTION_SIZE, interpolation=cv2.INTER_AREA)
+    
+    def should_upload(self, image):
+        """Decide si enviar el fotograma: devuelve (enviar, diferencia, miniatura)"""
+        signature = self.frame_signature(image)
+        if self.last_uploaded is None:
+            return True, None, signature
+        if self.last_status in ('error_pending', 'error_detected'):
+            # Tras un posible error el servidor necesita los fotogramas que lo
+            # confirmen, aunque un defecto estático apenas cambie la imagen
+            return True, None, signature
+        
+        # Diferencia media absoluta entre miniaturas, vectorizada con numpy
+        score = float(np.mean(np.abs(signature.astype(np.int16) - self.last_uploaded)))
+        if score >= CHANGE_THRESHOLD:
+            return True, score, signature
+        # Aunque no haya cambios, enviar de vez en cuando por seguridad
+        return time.monotonic() - self.last_upload_time >= MAX_SKIP_INTERVAL, score, signature
+    
+    def mark_uploaded(self, signature):
+        """Registrar el fotograma enviado como referencia para los siguientes"""
+        self.last_uploaded = signature.astype(np.int16)
+        self.last_upload_time = time.monotonic()
+    
+    def encode_image(self, image):
+        """Codificar el fotograma a JPEG una sola vez (se reutiliza para guardar y enviar)"""
+        success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if not success:
+            raise Exception("No se pudo codificar la imagen")
+        return buffer.tobytes()
+    
+    def send_image_to_server(self, jpeg):
+        """Enviar imagen JPEG al servidor para detección"""
         try:
-            # Codificar imagen a JPEG
-            _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            
-            # Preparar datos para envío
-            files = {'image': ('capture.jpg', buffer.tobytes(), 'image/jpeg')}
-            
             # Enviar al servidor
             logger.info("Enviando imagen al servidor...")
-            response = self.session.post(f"{SERVER_URL}/detect", files=files)
+            if UPLOAD_MODE == "raw":
+                # JPEG directo en el cuerpo: sin multipart en el servidor
+                response = self.session.post(
+                    f"{SERVER_URL}/detect",
+                    data=jpeg,
+                    headers={'Content-Type': 'image/jpeg'}
+                )
+            else:
+                files = {'image': ('capture.jpg', jpeg, 'image/jpeg')}
+                response = self.session.post(f"{SERVER_URL}/detect", files=files)
             
             if response.status_code == 200:
                 result = response.json()
@@ -101,12 +159,17 @@ class CameraClient:
                     
                     if result['status'] == 'error_detected':
                         logger.warning("⚠️ ERROR DETECTADO - Alerta enviada a Telegram")
+                    elif result['status'] == 'error_pending':
+                        logger.info("Posible error, pendiente de confirmación en los próximos fotogramas")
                     elif result['status'] == 'printing_normal':
                         logger.info("✅ Impresión normal detectada")
                 else:
                     logger.info("No se detectaron objetos")
                 
                 return result
+            elif response.status_code == 503:
+                self.handle_overload(response)
+                return None
             else:
                 logger.error(f"Error del servidor: {response.status_code} - {response.text}")
                 return None
@@ -118,12 +181,11 @@ class CameraClient:
             logger.error(f"Error al enviar imagen: {e}")
             return None
     
-    def send_image_base64(self, image):
+    def send_image_base64(self, jpeg):
         """Alternativa: enviar imagen en base64"""
         try:
             # Codificar imagen a base64
-            _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 85])
-            image_base64 = base64.b64encode(buffer).decode('utf-8')
+            image_base64 = base64.b64encode(jpeg).decode('utf-8')
             
             # Preparar datos JSON
             data = {'image': f"data:image/jpeg;base64,{image_base64}"}
@@ -140,6 +202,9 @@ class CameraClient:
                 result = response.json()
                 logger.info(f"Respuesta del servidor: {result}")
                 return result
+            elif response.status_code == 503:
+                self.handle_overload(response)
+                return None
             else:
                 logger.error(f"Error del servidor: {response.status_code} - {response.text}")
                 return None
@@ -148,6 +213,113 @@ class CameraClient:
             logger.error(f"Error al enviar imagen base64: {e}")
             return None
     
+    def update_interval(self, result):
+        """Adaptar el intervalo de captura al next_interval sugerido por el servidor"""
+        try:
+            interval = float(result['next_interval']) if result else CAPTURE_INTERVAL
+        except (KeyError, TypeError, ValueError):
+            interval = CAPTURE_INTERVAL
+        interval = min(max(interval, MIN_CAPTURE_INTERVAL), MAX_CAPTURE_INTERVAL)
+        if interval != self.capture_interval:
+            logger.info(f"Intervalo de captura ajustado a {interval:g} segundos")
+        self.capture_interval = interval
+    
+    def handle_overload(self, response):
+        """Servidor saturado (503): guardar el Retry-After para retrasar la próxima captura"""
+        try:
+            self.overload_hint = int(response.headers.get('Retry-After', CAPTURE_INTERVAL))
+        except ValueError:
+            self.overload_hint = CAPTURE_INTERVAL
+        logger.warning(f"Servidor saturado, reintentando en {self.overload_hint} segundos")
+    
+    def capture_loop(self, frames, stop):
+        """Hilo de captura: mantiene su ritmo aunque el envío anterior siga en curso"""
+        while not stop.is_set():
+            try:
+                # Capturar imagen
+                last_capture = time.monotonic()
+                image = self.capture_image()
+                if image is None:
+                    logger.warning("No se pudo capturar imagen, reintentando...")
+                    stop.wait(5)
+                    continue
+                
+                # Omitir el envío si la escena no cambió desde el último fotograma enviado
+                upload, score, signature = self.should_upload(image)
+                if upload:
+                    put_latest(frames, (datetime.now(), image, signature))
+                else:
+                    logger.info(f"Sin cambios (diferencia {score:.1f}), se omite el envío")
+                
+                # Esperar antes de la siguiente captura
+                self.wait_next_capture(last_capture, stop)
+                
+            except Exception as e:
+                logger.error(f"Error en el hilo de captura: {e}")
+                stop.wait(10)  # Esperar antes de reintentar
+    
+    def wait_next_capture(self, last_capture, stop):
+        """Esperar hasta la próxima captura, recalculando el plazo desde la última
+        cada vez que el hilo de envío recibe un nuevo next_interval o Retry-After"""
+        logged = None
+        while not stop.is_set():
+            self.schedule_changed.clear()
+            wait = max(self.capture_interval, self.retry_after or 0)
+            remaining = last_capture + wait - time.monotonic()
+            if remaining <= 0:
+                return
+            if wait != logged:
+                logger.info(f"Esperando {remaining:.0f} segundos para la próxima captura...")
+                logged = wait
+            self.schedule_changed.wait(remaining)
+    
+    def encode_loop(self, frames, uploads, stop):
+        """Hilo de codificación: JPEG del fotograma y copia local para depuración"""
+        while not stop.is_set():
+            try:
+                captured_at, image, signature = frames.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                jpeg = self.encode_image(image)
+                
+                # Guardar imagen local (opcional, para debug) sin volver a codificar
+                timestamp = captured_at.strftime("%Y%m%d_%H%M%S")
+                with open(f"captures/capture_{timestamp}.jpg", 'wb') as f:
+                    f.write(jpeg)
+                
+                put_latest(uploads, (jpeg, signature))
+            except Exception as e:
+                logger.error(f"Error en el hilo de codificación: {e}")
+    
+    def upload_loop(self, uploads, stop):
+        """Hilo de envío: siempre sube el JPEG más reciente disponible"""
+        while not stop.is_set():
+            try:
+                jpeg, signature = uploads.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                # Enviar al servidor
+                self.overload_hint = None
+                result = self.send_image_to_server(jpeg)
+                
+                # Si falla el método principal, intentar con base64 (salvo que el
+                # servidor esté saturado: reenviar solo duplicaría la carga)
+                if result is None and self.overload_hint is None:
+                    logger.info("Intentando método alternativo (base64)...")
+                    result = self.send_image_base64(jpeg)
+                
+                if result is not None:
+                    self.mark_uploaded(signature)
+                    self.last_status = result.get('status')
+                # Publicar el nuevo ritmo de una vez y despertar al hilo de captura
+                self.retry_after = self.overload_hint
+                self.update_interval(result)
+                self.schedule_changed.set()
+            except Exception as e:
+                logger.error(f"Error en el hilo de envío: {e}")
+    
     def test_server_connection(self):
         """Probar conexión con el servidor"""
         try:
@@ -175,8 +347,23 @@ class CameraClient:
                 self.camera.release()
         logger.info("Recursos de cámara liberados")
 
+def put_latest(items, item):
+    """Encolar sustituyendo el elemento pendiente si la cola está llena"""
+    while True:
+        try:
+            items.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                items.get_nowait()
+                logger.info("Cola llena, se descarta el fotograma anterior")
+            except queue.Empty:
+                pass
+
 def main():
     client = CameraClient()
+    stop = threading.Event()
+    threads = []
     
     try:
         # Probar conexión con el servidor
@@ -187,44 +374,34 @@ def main():
         # Inicializar cámara
         client.initialize_camera()
         
-        logger.info(f"Iniciando monitoreo cada {CAPTURE_INTERVAL} segundos")
+        logger.info(f"Iniciando monitoreo cada {CAPTURE_INTERVAL} segundos (adaptable por el servidor)")
         logger.info("Presiona Ctrl+C para detener")
         
-        while True:
-            try:
-                # Capturar imagen
-                image = client.capture_image()
-                if image is None:
-                    logger.warning("No se pudo capturar imagen, reintentando...")
-                    time.sleep(5)
-                    continue
-                
-                # Guardar imagen local (opcional, para debug)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                cv2.imwrite(f"captures/capture_{timestamp}.jpg", image)
-                
-                # Enviar al servidor
-                result = client.send_image_to_server(image)
-                
-                # Si falla el método principal, intentar con base64
-                if result is None:
-                    logger.info("Intentando método alternativo (base64)...")
-                    result = client.send_image_base64(image)
-                
-                # Esperar antes de la siguiente captura
-                logger.info(f"Esperando {CAPTURE_INTERVAL} segundos para la próxima captura...")
-                time.sleep(CAPTURE_INTERVAL)
-                
-            except KeyboardInterrupt:
-                logger.info("Interrupción por teclado recibida")
-                break
-            except Exception as e:
-                logger.error(f"Error en el bucle principal: {e}")
-                time.sleep(10)  # Esperar antes de reintentar
+        # Captura, codificación y envío en hilos separados unidos por colas de una
+        # sola plaza: una subida lenta no retrasa la siguiente captura y, al
+        # terminar, el envío recoge siempre el fotograma más reciente
+        frames = queue.Queue(maxsize=1)
+        uploads = queue.Queue(maxsize=1)
+        threads = [
+            threading.Thread(target=client.capture_loop, args=(frames, stop), name="captura", daemon=True),
+            threading.Thread(target=client.encode_loop, args=(frames, uploads, stop), name="codificacion", daemon=True),
+            threading.Thread(target=client.upload_loop, args=(uploads, stop), name="envio", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        
+        while not stop.wait(1):
+            pass
                 
+    except KeyboardInterrupt:
+        logger.info("Interrupción por teclado recibida")
     except Exception as e:
         logger.error(f"Error fatal: {e}")
     finally:
+        stop.set()
+        client.schedule_changed.set()
+        for thread in threads:
+            thread.join(timeout=client.session.timeout)
         client.cleanup()
         logger.info("Cliente finalizado")
 
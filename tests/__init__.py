@@ -0,0 +1,9 @@
+"""Pruebas unitarias de la lógica del servidor que no necesita el modelo.
+
+Ejecutar desde la raíz del repositorio con:
+    python -m unittest discover -v
+"""
+import os
+
+# Las pruebas no usan el modelo: evitar que app.py lo cargue al importarse
+os.environ.setdefault("MODEL_PATH", os.path.join(os.path.dirname(__file__), "sin_modelo.pt"))
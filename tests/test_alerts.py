@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import app
+
+
+class AlertSuppressorTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "estado.sqlite3")
+
+    def suppressor(self, **kwargs):
+        store = app.PrinterStateStore("alert_suppression", path=self.path)
+        return app.AlertSuppressor(store=store, **kwargs)
+
+    def test_requires_n_of_the_last_m_frames(self):
+        suppressor = self.suppressor(cooldown=60, confirm_n=2, confirm_m=3)
+        self.assertEqual(suppressor.check('p1', ['spaghetti'], now=0), (False, "pending_confirmation"))
+        self.assertEqual(suppressor.check('p1', [], now=1), (False, None))
+        self.assertEqual(suppressor.check('p1', ['Spaghetti'], now=2), (True, "new"))
+
+    def test_old_frames_leave_the_window(self):
+        suppressor = self.suppressor(cooldown=60, confirm_n=2, confirm_m=3)
+        for now, classes in enumerate((['spaghetti'], [], [])):
+            suppressor.check('p1', classes, now=now)
+        self.assertEqual(suppressor.check('p1', ['spaghetti'], now=3), (False, "pending_confirmation"))
+
+    def test_cooldown_per_class_and_escalation(self):
+        suppressor = self.suppressor(cooldown=60)
+        self.assertEqual(suppressor.check('p1', ['spaghetti'], now=0, confirmed=True), (True, "new"))
+        self.assertEqual(suppressor.check('p1', ['spaghetti'], now=30, confirmed=True), (False, "cooldown"))
+        self.assertEqual(suppressor.check('p1', ['spaghetti', 'layer_shift'], now=31, confirmed=True),
+                         (True, "escalation"))
+        self.assertEqual(suppressor.check('p1', ['spaghetti'], now=61, confirmed=True), (True, "new"))
+
+    def test_printers_are_independent(self):
+        suppressor = self.suppressor(cooldown=60)
+        self.assertTrue(suppressor.check('p1', ['spaghetti'], now=0, confirmed=True)[0])
+        self.assertTrue(suppressor.check('p2', ['spaghetti'], now=1, confirmed=True)[0])
+
+    def test_state_is_shared_between_workers(self):
+        # Dos instancias sobre el mismo fichero, como dos workers de gunicorn
+        first, second = self.suppressor(cooldown=60), self.suppressor(cooldown=60)
+        self.assertEqual(first.check('p1', ['spaghetti'], now=0), (False, "pending_confirmation"))
+        self.assertEqual(second.check('p1', ['spaghetti'], now=1), (True, "new"))
+        self.assertEqual(first.check('p1', ['spaghetti'], now=2), (False, "cooldown"))
+
+
+class PrinterStateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "estado.sqlite3")
+
+    def test_update_is_read_modify_write(self):
+        store = app.PrinterStateStore("counters", path=self.path)
+        increment = lambda state: ((state or 0) + 1, (state or 0) + 1)
+        self.assertEqual([store.update('p1', increment) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(store.update('p2', increment), 1)
+
+    def test_keeps_the_most_recently_updated_printers(self):
+        store = app.PrinterStateStore("counters", path=self.path, max_printers=2)
+        for printer_id in ('p1', 'p2', 'p3', 'p2'):
+            store.update(printer_id, lambda state: (1, None))
+        seen = store.update('p1', lambda state: (state, state))
+        self.assertIsNone(seen)
+
+    def test_falls_back_to_memory_when_sqlite_fails(self):
+        store = app.PrinterStateStore("counters", path=os.path.join(self.path, "no", "existe.sqlite3"))
+        with self.assertLogs(app.logger, level="ERROR"):
+            self.assertEqual(store.update('p1', lambda state: (1, state)), None)
+            self.assertEqual(store.update('p1', lambda state: (2, state)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+import export_model
+from tests.test_inference import FakeResults
+
+REFERENCE = [[10, 10, 60, 60, 0.9, 1], [200, 200, 300, 300, 0.8, 2]]
+
+
+class FakeModel:
+    """Modelo que devuelve siempre las mismas detecciones"""
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+    def __call__(self, image):
+        return FakeResults(self.boxes)
+
+
+class ParityTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for index in range(3):
+            cv2.imwrite(os.path.join(self.directory, f"capture_{index}.jpg"), np.zeros((64, 64, 3), np.uint8))
+        self.frames = export_model.load_frames(self.directory)
+
+    def test_identical_models_agree(self):
+        report = export_model.compare_models(FakeModel(REFERENCE), FakeModel(REFERENCE), self.frames)
+        self.assertEqual(report["frames"], 3)
+        self.assertEqual(report["agreement"], 1.0)
+        self.assertEqual(report["max_confidence_diff"], 0.0)
+
+    def test_missing_and_shifted_detections_lower_the_agreement(self):
+        candidate = [[12, 11, 61, 62, 0.85, 1]]
+        report = export_model.compare_models(FakeModel(REFERENCE), FakeModel(candidate), self.frames)
+        self.assertEqual(report["precision"], 1.0)
+        self.assertEqual(report["recall"], 0.5)
+        self.assertAlmostEqual(report["agreement"], 2 / 3)
+        self.assertAlmostEqual(report["max_confidence_diff"], 0.05, places=5)
+
+    def test_detections_of_another_class_do_not_match(self):
+        candidate = [[10, 10, 60, 60, 0.9, 2], [200, 200, 300, 300, 0.8, 2]]
+        report = export_model.compare_models(FakeModel(REFERENCE), FakeModel(candidate), self.frames)
+        self.assertEqual(report["matched"], 3)
+
+    def test_unreadable_frames_are_not_compared(self):
+        path = os.path.join(self.directory, "rota.jpg")
+        with open(path, 'wb') as f:
+            f.write(b'no es una imagen')
+        with self.assertLogs(export_model.logger, level="WARNING"):
+            report = export_model.compare_models(FakeModel(REFERENCE), FakeModel(REFERENCE), [path])
+        self.assertEqual(report["frames"], 0)
+
+    def test_check_only_fails_without_frames(self):
+        empty = tempfile.TemporaryDirectory()
+        self.addCleanup(empty.cleanup)
+        argv = ["export_model.py", "--check-only", "--frames", empty.name]
+        with mock.patch.object(sys, "argv", argv), self.assertRaises(SystemExit) as exit_info:
+            export_model.main()
+        self.assertNotIn(exit_info.exception.code, (0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import numpy as np
+
+import app
+
+NAMES = {0: 'imprimiendo', 1: 'spaghetti', 2: 'layer_shift'}
+
+
+class FakeResults:
+    """Lo mínimo de un objeto Detections de YOLOv5 que usa DetectionResult"""
+
+    def __init__(self, boxes):
+        self.xyxy = [self]
+        self.names = NAMES
+        self._boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 6)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._boxes
+
+
+class NonMaxSuppressionTest(unittest.TestCase):
+
+    def test_keeps_the_most_confident_of_overlapping_boxes(self):
+        boxes = np.array([[0, 0, 100, 100, 0.6, 1],
+                          [5, 5, 105, 105, 0.9, 1],
+                          [300, 300, 400, 400, 0.5, 1]], dtype=np.float32)
+        kept = app.non_max_suppression(boxes, iou_thres=0.5)
+        self.assertEqual(kept[:, 4].tolist(), [np.float32(0.9), np.float32(0.5)])
+
+    def test_classes_are_suppressed_independently(self):
+        boxes = np.array([[0, 0, 100, 100, 0.9, 1],
+                          [0, 0, 100, 100, 0.8, 2]], dtype=np.float32)
+        self.assertEqual(len(app.non_max_suppression(boxes, iou_thres=0.5)), 2)
+
+    def test_merges_duplicates_from_overlapping_tiles(self):
+        windows = [(0, 0, 640, 640), (320, 0, 960, 640)]
+        # El mismo objeto visto por los dos tiles, en coordenadas de cada tile
+        tile_results = [FakeResults([[400, 10, 500, 110, 0.8, 1]]),
+                        FakeResults([[80, 10, 180, 110, 0.7, 1], [500, 500, 600, 600, 0.6, 2]])]
+        merged = app.merge_tile_detections(tile_results, windows, iou_thres=0.5)
+        self.assertEqual(merged.labels.tolist(), ['spaghetti', 'layer_shift'])
+        self.assertEqual(merged.boxes[:, :4].tolist(), [[400, 10, 500, 110], [820, 500, 920, 600]])
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = app.ResultCache(max_printers=2, ttl=60, max_distance=4)
+        self.cache.put('p1', 0b1010, (720, 1280, 3), 'resultado', now=0)
+
+    def test_reuses_results_for_similar_frames(self):
+        self.assertEqual(self.cache.get('p1', 0b1010, (720, 1280, 3), now=1), 'resultado')
+        self.assertEqual(self.cache.get('p1', 0b0101, (720, 1280, 3), now=1), 'resultado')
+
+    def test_misses_on_different_frames_or_sizes(self):
+        self.assertIsNone(self.cache.get('p1', 0b1010 ^ 0b11111, (720, 1280, 3), now=1))
+        self.assertIsNone(self.cache.get('p1', 0b1010, (360, 640, 3), now=1))
+        self.assertIsNone(self.cache.get('p2', 0b1010, (720, 1280, 3), now=1))
+
+    def test_hits_do_not_extend_the_ttl(self):
+        self.assertIsNotNone(self.cache.get('p1', 0b1010, (720, 1280, 3), now=59))
+        self.assertIsNone(self.cache.get('p1', 0b1010, (720, 1280, 3), now=61))
+
+    def test_evicts_the_least_recently_used_printer(self):
+        self.cache.put('p2', 0, (1, 1, 3), 'p2', now=1)
+        self.cache.get('p1', 0b1010, (720, 1280, 3), now=2)
+        self.cache.put('p3', 0, (1, 1, 3), 'p3', now=3)
+        self.assertIsNotNone(self.cache.get('p1', 0b1010, (720, 1280, 3), now=4))
+        self.assertIsNone(self.cache.get('p2', 0, (1, 1, 3), now=4))
+
+    def test_frame_hash_tolerates_noise(self):
+        rng = np.random.default_rng(0)
+        image = np.tile(np.linspace(0, 255, 320, dtype=np.uint8), (240, 1))[:, :, None].repeat(3, axis=2)
+        image[60:180, 100:200] = 255 - image[60:180, 100:200]
+        noisy = np.clip(image + rng.integers(-3, 4, image.shape), 0, 255).astype(np.uint8)
+        other = image[::-1, ::-1].copy()
+        self.assertLessEqual((app.frame_hash(image) ^ app.frame_hash(noisy)).bit_count(), 4)
+        self.assertGreater((app.frame_hash(image) ^ app.frame_hash(other)).bit_count(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import base64
+import unittest
+
+import cv2
+import numpy as np
+
+import app
+
+
+def encode(extension, width, height):
+    return cv2.imencode(extension, np.zeros((height, width, 3), np.uint8))[1].tobytes()
+
+
+class Base64StreamDecoderTest(unittest.TestCase):
+
+    def decode(self, body, chunk_size):
+        decoder = app.Base64StreamDecoder(len(body))
+        for start in range(0, len(body), chunk_size):
+            if decoder.feed(body[start:start + chunk_size]):
+                break
+        self.assertTrue(decoder.done)
+        return bytes(decoder.result())
+
+    def test_decodes_across_chunk_boundaries(self):
+        data = bytes(range(256)) * 10
+        body = b'{"printer": "p1", "image": "' + base64.b64encode(data) + b'", "extra": 1}'
+        for chunk_size in (1, 3, 7, 64, len(body)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.decode(body, chunk_size), data)
+
+    def test_strips_data_uri_prefix_and_json_escapes(self):
+        data = b'\xff\xd8' + bytes(range(200)) * 3
+        encoded = base64.encodebytes(data).replace(b'\n', b'\\n').replace(b'/', b'\\/')
+        body = b'{"image": "data:image/jpeg;base64,' + encoded + b'"}'
+        for chunk_size in (1, 5, len(body)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.decode(body, chunk_size), data)
+
+    def test_invalid_base64_is_an_input_error(self):
+        with self.assertRaises(app.InputError):
+            self.decode(b'{"image": "abcde"}', 64)
+
+    def test_missing_image_key_never_completes(self):
+        decoder = app.Base64StreamDecoder()
+        self.assertFalse(decoder.feed(b'{"foto": "AAAA"}'))
+        self.assertFalse(decoder.done)
+
+
+class ReadImageHeaderTest(unittest.TestCase):
+
+    def test_jpeg(self):
+        self.assertEqual(app.read_image_header(encode('.jpg', 320, 240)), ('jpeg', 320, 240))
+
+    def test_png(self):
+        self.assertEqual(app.read_image_header(encode('.png', 64, 48)), ('png', 64, 48))
+
+    def test_accepts_buffers_without_copying(self):
+        data = bytearray(encode('.jpg', 100, 50))
+        self.assertEqual(app.read_image_header(memoryview(data)), ('jpeg', 100, 50))
+
+    def test_unknown_or_truncated_data(self):
+        self.assertIsNone(app.read_image_header(b''))
+        self.assertIsNone(app.read_image_header(b'GIF89a......'))
+        self.assertIsNone(app.read_image_header(encode('.jpg', 320, 240)[:20]))
+
+
+class DecodeImageTest(unittest.TestCase):
+
+    def test_reduced_decode_keeps_the_long_side_at_network_size(self):
+        image, scale = app.decode_image(encode('.jpg', 2592, 1944), inference_size=640)
+        self.assertEqual(image.shape[:2], (486, 648))
+        self.assertEqual(scale, (4.0, 4.0))
+
+    def test_reduced_decode_keeps_the_roi_crop_at_network_size(self):
+        roi = (0, 0, 0.5, 1)
+        # La mitad de 1280x720 ya mide 640x720: no se puede reducir
+        image, scale = app.decode_image(encode('.jpg', 1280, 720), inference_size=640, roi=roi)
+        self.assertEqual(image.shape[:2], (720, 1280))
+        self.assertEqual(scale, (1.0, 1.0))
+
+        image, scale = app.decode_image(encode('.jpg', 2560, 1440), inference_size=640, roi=roi)
+        x1, y1, x2, y2 = app.roi_pixels(roi, image.shape[1], image.shape[0])
+        self.assertEqual((x2 - x1, y2 - y1), (640, 720))
+        self.assertEqual(scale, (2.0, 2.0))
+
+    def test_full_resolution_without_inference_size(self):
+        image, scale = app.decode_image(encode('.jpg', 1280, 720), inference_size=None)
+        self.assertEqual(image.shape[:2], (720, 1280))
+        self.assertEqual(scale, (1.0, 1.0))
+
+
+class TileWindowsTest(unittest.TestCase):
+
+    def test_image_no_larger_than_a_tile_is_inferred_once(self):
+        self.assertEqual(app.tile_windows(300, 200, tile_size=640, overlap=0.2, include_full=True),
+                         [(0, 0, 300, 200)])
+        self.assertEqual(app.tile_windows(300, 200, tile_size=640, overlap=0.2, include_full=False),
+                         [(0, 0, 300, 200)])
+
+    def test_tiles_are_spread_evenly(self):
+        windows = app.tile_windows(1280, 720, tile_size=640, overlap=0.2, include_full=False)
+        self.assertEqual(sorted({x1 for x1, _, _, _ in windows}), [0, 320, 640])
+        self.assertEqual(sorted({y1 for _, y1, _, _ in windows}), [0, 80])
+        self.assertTrue(all(x2 - x1 == 640 and y2 - y1 == 640 for x1, y1, x2, y2 in windows))
+
+    def test_tiles_cover_the_image_with_the_requested_overlap(self):
+        for length in (641, 1000, 1920, 4056):
+            with self.subTest(length=length):
+                windows = app.tile_windows(length, 100, tile_size=640, overlap=0.2, include_full=False)
+                starts = sorted(x1 for x1, _, _, _ in windows)
+                self.assertEqual(starts[0], 0)
+                self.assertEqual(starts[-1] + 640, length)
+                self.assertTrue(all(640 - (b - a) >= int(640 * 0.2) for a, b in zip(starts, starts[1:])))
+
+    def test_full_frame_comes_first(self):
+        windows = app.tile_windows(1280, 720, tile_size=640, overlap=0.2, include_full=True)
+        self.assertEqual(windows[0], (0, 0, 1280, 720))
+        self.assertEqual(windows.count((0, 0, 1280, 720)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
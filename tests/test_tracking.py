@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+import app
+
+NAMES = {0: 'imprimiendo', 1: 'spaghetti'}
+SPAGHETTI = [10, 10, 60, 60, 0.4, 1]
+PRINTING = [0, 0, 300, 300, 0.9, 0]
+
+
+def detections(*boxes):
+    return app.DetectionResult(list(boxes), NAMES)
+
+
+class TemporalTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "estado.sqlite3")
+
+    def tracker(self, **kwargs):
+        store = app.PrinterStateStore("temporal_tracking", path=self.path)
+        options = dict(alpha=0.5, iou_thres=0.3, min_hits=2, window=3, ttl=900)
+        options.update(kwargs)
+        return app.TemporalTracker(store=store, **options)
+
+    def test_persistent_error_is_confirmed_regardless_of_confidence(self):
+        tracker = self.tracker()
+        statuses = [tracker.update('p1', detections(SPAGHETTI), now=now)["status"] for now in range(3)]
+        self.assertEqual(statuses, ["error_pending", "error_detected", "error_detected"])
+        self.assertEqual(tracker.update('p1', detections(SPAGHETTI), now=3)["error_classes"], ["spaghetti"])
+
+    def test_single_false_positive_is_never_confirmed(self):
+        tracker = self.tracker()
+        frames = [detections([10, 10, 60, 60, 0.95, 1]),
+                  detections(PRINTING), detections(PRINTING), detections(PRINTING)]
+        summaries = [tracker.update('p1', frame, now=now) for now, frame in enumerate(frames)]
+        self.assertEqual([s["status"] for s in summaries],
+                         ["error_pending", "printing_normal", "printing_normal", "printing_normal"])
+        # Tras una ventana entera sin verse, la pista del falso positivo desaparece
+        self.assertEqual([track["name"] for track in summaries[-1]["tracks"]], ["imprimiendo"])
+
+    def test_detections_are_associated_by_iou(self):
+        tracker = self.tracker()
+        first = tracker.update('p1', detections(SPAGHETTI), now=0)["tracks"][0]
+        moved = tracker.update('p1', detections([14, 12, 64, 62, 0.6, 1]), now=1)["tracks"][0]
+        self.assertEqual(moved["id"], first["id"])
+        self.assertEqual(moved["hits"], 2)
+        self.assertAlmostEqual(moved["confidence"], 0.5 * 0.6 + 0.5 * 0.4, places=5)
+
+        far = tracker.update('p1', detections([400, 400, 450, 450, 0.6, 1]), now=2)["tracks"]
+        self.assertEqual(len(far), 2)
+        self.assertNotEqual(far[1]["id"], first["id"])
+
+    def test_sequence_restarts_after_the_ttl(self):
+        tracker = self.tracker(ttl=60)
+        tracker.update('p1', detections(SPAGHETTI), now=0)
+        self.assertEqual(tracker.update('p1', detections(SPAGHETTI), now=1)["status"], "error_detected")
+        self.assertEqual(tracker.update('p1', detections(SPAGHETTI), now=100)["status"], "error_pending")
+
+    def test_frames_from_different_workers_form_one_sequence(self):
+        first, second = self.tracker(), self.tracker()
+        self.assertEqual(first.update('p1', detections(SPAGHETTI), now=0)["status"], "error_pending")
+        self.assertEqual(second.update('p1', detections(SPAGHETTI), now=1)["status"], "error_detected")
+        self.assertEqual(second.update('p2', detections(SPAGHETTI), now=1)["status"], "error_pending")
+
+    def test_idle_and_printing_frames(self):
+        tracker = self.tracker()
+        self.assertEqual(tracker.update('p1', detections(), now=0)["status"], "normal")
+        summary = tracker.update('p1', detections(PRINTING), now=1)
+        self.assertEqual(summary["status"], "printing_normal")
+        self.assertEqual(summary["error_ratio"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()